@@ -1,42 +1,85 @@
+import asyncio
+import hashlib
+import json
 import logging
 import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from typing import cast
 from xml.dom.minidom import getDOMImplementation
 
-from dls_pmacanalyse.errors import ConfigError, PmacReadError
+from dls_pmacanalyse import __version__
+from dls_pmacanalyse.errors import (
+    ConfigError,
+    PmacReadError,
+    UnresolvedExpressionError,
+)
 from dls_pmacanalyse.globalconfig import GlobalConfig
-from dls_pmacanalyse.pmacstate import PmacState
+from dls_pmacanalyse.pmacstate import PmacState, UnreadPmacState
 from dls_pmacanalyse.pmacvariables import PmacMVariable
 from dls_pmacanalyse.webpage import WebPage
 
 log = logging.getLogger(__name__)
 
+# The analysis used by a worker process for its factory settings
+workerAnalyse = None
+
+
+def loadPmacFiles(pickledPmac, includePaths, cacheDir, unread=False):
+    """Loads the files of a pickled PMAC in a worker process, returning the
+    variables to be passed to setLoadedFiles.  If the hardware of the PMAC
+    is being read at the same time, unread is set and None is returned when
+    the reference has inline expressions that need the hardware values."""
+    global workerAnalyse
+    pmac = pickle.loads(pickledPmac)
+    if unread:
+        pmac.hardwareState = UnreadPmacState("hardware")
+    if workerAnalyse is None:
+        config = GlobalConfig()
+        config.includePaths = includePaths
+        config.cacheDir = cacheDir
+        workerAnalyse = Analyse(config)
+    try:
+        hardwareVars = pmac.loadFiles(
+            workerAnalyse.getPmacFactorySettings(pmac), includePaths, cacheDir
+        )
+    except UnresolvedExpressionError:
+        return None
+    return (hardwareVars, pmac.referenceState.vars)
+
 
 class Analyse:
     def __init__(self, config: GlobalConfig):
         """Constructor."""
         self.config = config
-        self.pmacFactorySettings = PmacState("pmacFactorySettings")
-        self.geobrickFactorySettings = PmacState("geobrickFactorySettings")
+        # The factory settings of each PMAC type, loaded when first used
+        self.factorySettings: dict[str, PmacState] = {}
+
+    def getFactorySettings(self, geobrick):
+        """Returns the factory settings of a PMAC type, loading them on first
+        use.  The state is shared by every PMAC of the type, which must only
+        copy from it."""
+        name = "geobrick" if geobrick else "pmac"
+        if name not in self.factorySettings:
+            state = PmacState(f"{name}FactorySettings")
+            self.loadFactorySettings(
+                state,
+                os.path.join(os.path.dirname(__file__), f"factorySettings_{name}.pmc"),
+                self.config.includePaths,
+            )
+            self.factorySettings[name] = state
+        return self.factorySettings[name]
+
+    def getPmacFactorySettings(self, pmac):
+        """Returns the factory settings that a PMAC's reference is layered
+        over, or None if it does not use them."""
+        if pmac.useFactoryDefs:
+            return self.getFactorySettings(pmac.geobrick)
+        return None
 
     def analyse(self):
         """Performs the analysis of the PMACs."""
-        # Load the factory settings
-        factorySettingsFilename = os.path.join(
-            os.path.dirname(__file__), "factorySettings_pmac.pmc"
-        )
-        self.loadFactorySettings(
-            self.pmacFactorySettings, factorySettingsFilename, self.config.includePaths
-        )
-        factorySettingsFilename = os.path.join(
-            os.path.dirname(__file__), "factorySettings_geobrick.pmc"
-        )
-        self.loadFactorySettings(
-            self.geobrickFactorySettings,
-            factorySettingsFilename,
-            self.config.includePaths,
-        )
         # Make sure the results directory exists
         if self.config.writeAnalysis:
             if not os.path.exists(self.config.resultsDir):
@@ -53,6 +96,14 @@ class Analyse:
                 raise ConfigError(
                     f"Backup path exists but is not a directory: {self.config.backupDir}"
                 )
+        # Make sure the session recording directory exists if it is required
+        if self.config.recordDir is not None:
+            if not os.path.exists(self.config.recordDir):
+                os.makedirs(self.config.recordDir)
+            elif not os.path.isdir(self.config.recordDir):
+                raise ConfigError(
+                    f"Record path exists but is not a directory: {self.config.recordDir}"
+                )
         if self.config.writeAnalysis is True:
             # Drop a style sheet
             wFile = open(f"{self.config.resultsDir}/analysis.css", "w+")
@@ -69,6 +120,19 @@ class Analyse:
                 #code{font-family:courier}
                 """
             )
+        pmacs = [
+            pmac
+            for name, pmac in self.config.pmacs.items()
+            if self.config.onlyPmacs is None or name in self.config.onlyPmacs
+        ]
+        if self.config.pipeline:
+            # Load the files of each pmac while the hardware is read
+            self.readHardwareAndLoadFiles(pmacs)
+        else:
+            # Read the hardware of each pmac, in parallel if more than one job
+            self.readHardware(pmacs)
+            # Load the compare with and reference files of each pmac
+            self.loadFiles(pmacs)
         # Analyse each pmac
         for name, pmac in self.config.pmacs.items():
             if self.config.onlyPmacs is None or name in self.config.onlyPmacs:
@@ -80,30 +144,6 @@ class Analyse:
                     f"{self.config.resultsDir}/{pmac.name}_compare.htm",
                     styleSheet="analysis.css",
                 )
-                # Read the hardware (or compare with file)
-                if pmac.compareWith is None:
-                    try:
-                        pmac.readHardware(
-                            self.config.backupDir,
-                            self.config.checkPositions,
-                            self.config.debug,
-                            self.config.comments,
-                            self.config.verbose,
-                        )
-                    except PmacReadError:
-                        msg = "FAILED TO CONNECT TO " + pmac.name
-                        log.debug(msg, exc_info=True)
-                        log.error(msg)
-                else:
-                    pmac.loadCompareWith()
-                # Load the reference
-                factoryDefs = None
-                if pmac.useFactoryDefs:
-                    if pmac.geobrick:
-                        factoryDefs = self.geobrickFactorySettings
-                    else:
-                        factoryDefs = self.pmacFactorySettings
-                pmac.loadReference(factoryDefs, self.config.includePaths)
                 # Make the comparison
                 theFixFile = None
                 if self.config.fixfile is not None:
@@ -192,7 +232,9 @@ class Analyse:
                     f"{pmac.name}_motionprogs.htm",
                     "Motion programs",
                 )
+            self.htmlReadoutTiming(indexPage)
             indexPage.write()
+            self.writeReadoutTiming(f"{self.config.resultsDir}/timing.json")
             # Dump the I variables for each pmac
             for name, pmac in self.config.pmacs.items():
                 if self.config.onlyPmacs is None or name in self.config.onlyPmacs:
@@ -238,7 +280,7 @@ class Analyse:
             # Dump the macrostation I variables for each pmac
             for name, pmac in self.config.pmacs.items():
                 if self.config.onlyPmacs is None or name in self.config.onlyPmacs:
-                    if pmac.numMacroStationIcs > 0:
+                    if pmac.numMacroStationIcs:
                         # Create the MS,I variables top level web page
                         page = WebPage(
                             "Macrostation I Variables for {} ({})".format(
@@ -513,7 +555,225 @@ class Analyse:
                         page.write()
             self.hudsonXmlReport()
 
+    def readHardware(self, pmacs):
+        """Reads the hardware of the PMACs that are not compared with a file.
+        When more than one job is configured the PMACs are read concurrently
+        by a pool of worker threads.  The readout is almost entirely network
+        latency bound so this scales well, and as the reference loading,
+        comparison and reporting are still done in configuration order the
+        results are identical to a sequential run."""
+        pmacs = [pmac for pmac in pmacs if pmac.compareWith is None]
+        for pmac in pmacs:
+            if self.config.recordDir is not None:
+                pmac.setRecordFile(
+                    os.path.join(self.config.recordDir, f"{pmac.name}.session.gz")
+                )
+            if self.config.replayDir is not None:
+                pmac.setReplayFile(
+                    os.path.join(self.config.replayDir, f"{pmac.name}.session.gz"),
+                    self.config.replayRealTime,
+                )
+            if self.config.cacheDir is not None:
+                pmac.setBlockSizeFile(self.blockSizeCacheFile(pmac))
+        if self.config.useAsyncio:
+            asyncio.run(self.readHardwareAsync(pmacs))
+        elif self.config.jobs > 1 and len(pmacs) > 1:
+            log.info(f"Reading {len(pmacs)} PMACs using {self.config.jobs} jobs")
+            with ThreadPoolExecutor(max_workers=self.config.jobs) as executor:
+                futures = [
+                    executor.submit(self.readPmacHardware, pmac) for pmac in pmacs
+                ]
+                for future in futures:
+                    future.result()
+        else:
+            for pmac in pmacs:
+                self.readPmacHardware(pmac)
+
+    def loadFiles(self, pmacs):
+        """Loads the compare with and reference files of the PMACs.  Parsing
+        the files is CPU bound, so when more than one parse job is configured
+        they are parsed by a pool of worker processes.  Each worker sends back only
+        the variables it loaded, the reference variables being layered over
+        the factory settings of this process."""
+        if self.config.parseJobs > 1 and len(pmacs) > 1:
+            log.info(f"Loading {len(pmacs)} PMACs using {self.config.parseJobs} jobs")
+            with ProcessPoolExecutor(max_workers=self.config.parseJobs) as executor:
+                futures = [
+                    executor.submit(
+                        loadPmacFiles,
+                        pickle.dumps(pmac),
+                        self.config.includePaths,
+                        self.config.cacheDir,
+                    )
+                    for pmac in pmacs
+                ]
+                for pmac, future in zip(pmacs, futures, strict=True):
+                    (hardwareVars, referenceVars) = future.result()
+                    pmac.setLoadedFiles(
+                        hardwareVars, referenceVars, self.getPmacFactorySettings(pmac)
+                    )
+        else:
+            for pmac in pmacs:
+                pmac.loadFiles(
+                    self.getPmacFactorySettings(pmac),
+                    self.config.includePaths,
+                    self.config.cacheDir,
+                )
+
+    def readHardwareAndLoadFiles(self, pmacs):
+        """Reads the hardware of the PMACs while worker processes load their
+        compare with and reference files, so that the time taken is that of
+        the longer of the two rather than their sum.  A reference whose inline
+        expressions need the hardware values, or that was loaded over the
+        wrong factory settings because the PMAC type was not known until the
+        readout, is loaded again once the hardware has been read."""
+        log.info(f"Loading {len(pmacs)} PMACs while reading their hardware")
+        with ProcessPoolExecutor(max_workers=self.config.parseJobs) as executor:
+            loads = []
+            for pmac in pmacs:
+                # Pickle the PMAC now, before the readout starts changing it
+                future = executor.submit(
+                    loadPmacFiles,
+                    pickle.dumps(pmac),
+                    self.config.includePaths,
+                    self.config.cacheDir,
+                    pmac.compareWith is None,
+                )
+                loads.append((pmac, bool(pmac.geobrick), future))
+            self.readHardware(pmacs)
+            for pmac, geobrick, future in loads:
+                result = future.result()
+                if result is None or (
+                    pmac.useFactoryDefs and bool(pmac.geobrick) != geobrick
+                ):
+                    log.info(f"Loading the files of {pmac.name} again")
+                    pmac.loadFiles(
+                        self.getPmacFactorySettings(pmac),
+                        self.config.includePaths,
+                        self.config.cacheDir,
+                    )
+                else:
+                    (hardwareVars, referenceVars) = result
+                    pmac.setLoadedFiles(
+                        hardwareVars, referenceVars, self.getPmacFactorySettings(pmac)
+                    )
+
+    def readPmacHardware(self, pmac):
+        """Reads the hardware of a single PMAC.  A read failure is reported
+        and only affects this PMAC."""
+        try:
+            pmac.readHardware(
+                self.config.backupDir,
+                self.config.checkPositions,
+                self.config.debug,
+                self.config.comments,
+                self.config.verbose,
+                self.config.incremental,
+            )
+        except PmacReadError:
+            msg = "FAILED TO CONNECT TO " + pmac.name
+            log.debug(msg, exc_info=True)
+            log.error(msg)
+
+    async def readHardwareAsync(self, pmacs):
+        """Reads the hardware of the PMACs using a single asyncio event loop.
+        At most jobs PMACs are read at once, and at most hostJobs of those
+        through any one host."""
+        jobs = asyncio.Semaphore(self.config.jobs)
+        hostJobs = {}
+        for pmac in pmacs:
+            if self.config.hostJobs is not None and pmac.host not in hostJobs:
+                hostJobs[pmac.host] = asyncio.Semaphore(self.config.hostJobs)
+        log.info(f"Reading {len(pmacs)} PMACs using asyncio")
+
+        async def readOne(pmac):
+            async with jobs:
+                if pmac.host in hostJobs:
+                    async with hostJobs[pmac.host]:
+                        await self.readPmacHardwareAsync(pmac)
+                else:
+                    await self.readPmacHardwareAsync(pmac)
+
+        await asyncio.gather(*[readOne(pmac) for pmac in pmacs])
+
+    async def readPmacHardwareAsync(self, pmac):
+        """Reads the hardware of a single PMAC using asyncio.  A read failure
+        is reported and only affects this PMAC."""
+        try:
+            await pmac.readHardwareAsync(
+                self.config.backupDir,
+                self.config.checkPositions,
+                self.config.debug,
+                self.config.comments,
+                self.config.verbose,
+                self.config.incremental,
+            )
+        except PmacReadError:
+            msg = "FAILED TO CONNECT TO " + pmac.name
+            log.debug(msg, exc_info=True)
+            log.error(msg)
+
+    def timedPmacs(self):
+        """Returns the PMACs whose hardware was read, and so have a timing."""
+        return [pmac for pmac in self.config.pmacs.values() if pmac.timing.phases]
+
+    def writeReadoutTiming(self, fileName):
+        """Writes the readout timing of each PMAC as JSON."""
+        log.info(f"Writing readout timing {fileName}")
+        with open(fileName, "w") as file:
+            json.dump(
+                {pmac.name: pmac.timing.summary() for pmac in self.timedPmacs()},
+                file,
+                indent=2,
+            )
+
+    def htmlReadoutTiming(self, page):
+        """Adds a table of the readout timing of each PMAC, phase by phase,
+        to a web page."""
+        pmacs = self.timedPmacs()
+        if not pmacs:
+            return
+        page.paragraph(page.body(), "Readout timing")
+        table = page.table(
+            page.body(),
+            [
+                "PMAC",
+                "Phase",
+                "Commands",
+                "Seconds",
+                "Max latency",
+                "Bytes sent",
+                "Bytes received",
+            ],
+        )
+        for pmac in pmacs:
+            total = pmac.timing.total()
+            total.name = f"total ({pmac.timing.wallSeconds:.3f}s elapsed)"
+            for phase in list(pmac.timing.phases.values()) + [total]:
+                page.tableRow(
+                    table,
+                    [
+                        pmac.name,
+                        phase.name,
+                        phase.commands,
+                        f"{phase.seconds:.3f}",
+                        f"{phase.maxSeconds:.3f}",
+                        phase.bytesSent,
+                        phase.bytesReceived,
+                    ],
+                )
+
+    # Format of the cached factory settings
+    factorySettingsCacheVersion = 5
+
     def loadFactorySettings(self, pmac, fileName, includeFiles):
+        """Loads the factory settings of a PMAC type into a state.  The parsed
+        settings are cached in the cache directory, keyed on the content of
+        the settings file, the include paths and the package version, so that
+        later runs need not parse them again."""
+        cacheFile = self.factorySettingsCacheFile(fileName, includeFiles)
+        if cacheFile is not None and self.loadCachedFactorySettings(pmac, cacheFile):
+            return
         for i in range(8192):
             pmac.getIVariable(i)
         for m in range(8192):
@@ -526,6 +786,77 @@ class Analyse:
             for q in range(1, 200):
                 pmac.getQVariable(cs, q)
         pmac.loadPmcFileWithPreprocess(fileName, includeFiles)
+        if cacheFile is not None:
+            self.writeCachedFactorySettings(pmac, cacheFile)
+
+    def factorySettingsCacheFile(self, fileName, includeFiles):
+        """Returns the name of the cache file for a factory settings file, or
+        None if there is no cache.  The cache files of a settings file, read
+        with the same include paths by the same package version, are kept in
+        a directory of their own, so entries in that directory differ only in
+        the content of the settings file and all but the newest are out of
+        date.  Other installs and include paths keep their own entries."""
+        if self.config.cacheDir is None:
+            return None
+        setting = hashlib.sha256(
+            f"{os.path.abspath(fileName)}\0{includeFiles}\0{__version__}".encode()
+        )
+        key = hashlib.sha256()
+        with open(fileName, "rb") as file:
+            key.update(file.read())
+        name = os.path.splitext(os.path.basename(fileName))[0]
+        return os.path.join(
+            self.config.cacheDir,
+            f"{name}-{setting.hexdigest()[:16]}",
+            f"{key.hexdigest()[:32]}.pickle",
+        )
+
+    def blockSizeCacheFile(self, pmac):
+        """Returns the name of the file that keeps the range command block
+        sizes learnt by readouts of the PMAC at an address."""
+        key = hashlib.sha256(f"{pmac.host}\0{pmac.port}\0{pmac.termServ}".encode())
+        return os.path.join(
+            self.config.cacheDir, "blocksizes", f"{key.hexdigest()[:16]}.json"
+        )
+
+    def loadCachedFactorySettings(self, pmac, cacheFile):
+        """Loads the cached factory settings into a state.  Returns False if
+        there is no usable cache file."""
+        if not os.path.exists(cacheFile):
+            return False
+        try:
+            with open(cacheFile, "rb") as file:
+                version, variables = pickle.load(file)
+        except Exception as e:
+            log.warning(f"Ignoring factory settings cache {cacheFile}: {e}")
+            return False
+        if version != Analyse.factorySettingsCacheVersion:
+            return False
+        log.info(f"Using cached factory settings {cacheFile}")
+        pmac.vars = variables
+        return True
+
+    def writeCachedFactorySettings(self, pmac, cacheFile):
+        """Caches the factory settings of a state, replacing the cache files
+        of earlier contents of the same settings file.  Failing to write the
+        cache is not an error."""
+        cacheDir = os.path.dirname(cacheFile)
+        try:
+            os.makedirs(cacheDir, exist_ok=True)
+            tmpFile = f"{cacheFile}.{os.getpid()}.tmp"
+            with open(tmpFile, "wb") as file:
+                pickle.dump(
+                    (Analyse.factorySettingsCacheVersion, pmac.vars),
+                    file,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            os.replace(tmpFile, cacheFile)
+            for name in os.listdir(cacheDir):
+                path = os.path.join(cacheDir, name)
+                if name.endswith(".pickle") and path != cacheFile:
+                    os.remove(path)
+        except OSError as e:
+            log.warning(f"Could not write factory settings cache {cacheFile}: {e}")
 
     def hudsonXmlReport(self):
         # Write out an XML report for Hudson
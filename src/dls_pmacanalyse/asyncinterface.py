@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import re
+import struct
+from abc import ABC, abstractmethod
+
+log = logging.getLogger(__name__)
+
+CHAR_ACK = "\x06"
+CHAR_RETURN = "\r"
+CHAR_NULL = "\x00"
+VALID_ENDS = (CHAR_ACK, CHAR_RETURN)
+
+
+class AsyncRemotePmacInterface(ABC):
+    """The asyncio counterpart of dls_pmaclib's RemotePmacInterface.  Only the
+    connection handling and sendCommand are provided, which is all that
+    the hardware readout requires.  A lock serialises the commands sent over
+    the connection so a single interface may be shared between tasks."""
+
+    def __init__(self, verbose=False, timeout=3.0):
+        self.verboseMode = verbose
+        self.timeout = timeout
+        self.hostname = ""
+        self.port = None
+        self.reader = None
+        self.writer = None
+        self.isConnectionOpen = False
+        self.lock = asyncio.Lock()
+
+    def setConnectionParams(self, host="localhost", port=None):
+        self.hostname = str(host)
+        if port:
+            self.port = int(str(port))
+        else:
+            self.port = None
+
+    async def connect(self):
+        """Connects to the PMAC.  Returns None on success or an error message
+        on failure."""
+        if self.isConnectionOpen:
+            return "Socket is already open"
+        if self.hostname in (None, "") or self.port in (None, 0):
+            return "ERROR: hostname or port number not set"
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.hostname, self.port), self.timeout
+            )
+        except OSError as e:
+            return f"ERROR: could not connect to host: {e}"
+        except asyncio.TimeoutError:
+            return "ERROR: timed out connecting to host"
+        self.isConnectionOpen = True
+        if self.verboseMode:
+            log.warning(f'Connected to host "{self.hostname}" on port {self.port}')
+        return await self.checkConnection()
+
+    async def checkConnection(self):
+        """Checks that the other end of the connection is a PMAC."""
+        return None
+
+    async def disconnect(self):
+        if self.isConnectionOpen:
+            self.isConnectionOpen = False
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            if self.verboseMode:
+                log.warning("Disconnected from " + self.hostname)
+
+    async def sendCommand(self, command):
+        """Sends a command to the PMAC and waits for the response.  Returns a
+        tuple (response, wasSuccessful) in the same way as the blocking
+        interfaces: wasSuccessful is False only for I/O errors, a PMAC error
+        reply such as ERR003 is still a successful transmission."""
+        command = str(command)
+        try:
+            async with self.lock:
+                response = await asyncio.wait_for(
+                    self._sendCommand(command), self.timeout
+                )
+        except asyncio.TimeoutError:
+            return "I/O error during comm with PMAC: timed out", False
+        except OSError as e:
+            return f"I/O error during comm with PMAC: {str(e)}", False
+        return response, True
+
+    @abstractmethod
+    async def _sendCommand(self, command):
+        """Sends a command over the open connection and returns the reply,
+        raising OSError if the reply is not received intact."""
+
+
+class AsyncPmacEthernetInterface(AsyncRemotePmacInterface):
+    """Asyncio connection to a PMAC over TCP/IP, using the same
+    VR_PMAC_GETRESPONSE protocol as dls_pmaclib's PmacEthernetInterface."""
+
+    getbufferRequest = struct.pack("8B", 0xC0, 0xC5, 0x0, 0x0, 0x0, 0x0, 0x08, 0x0)
+
+    async def checkConnection(self):
+        # Check that we are connected to a pmac by issuing the "ver" command
+        response, status = await self.sendCommand("i6=1 i3=2 ver")
+        if not status:
+            await self.disconnect()
+            return 'Device failed to respond to a "ver" command'
+        if not re.match(r"^\d+\.\d+\s*\r\x06$", response):
+            await self.disconnect()
+            return 'Device did not respond correctly to a "ver" command'
+        return None
+
+    @staticmethod
+    def getresponseRequest(command):
+        data = bytes(command, "utf-8")
+        return struct.pack(">BBHHH", 0x40, 0xBF, 0x0, 0x0, len(data)) + data
+
+    async def _sendCommand(self, command):
+        self.writer.write(self.getresponseRequest(command))
+        await self.writer.drain()
+        if self.verboseMode:
+            log.error(f"Sent out: {command!r}")
+        returnStr = (await self.reader.read(2048)).decode()
+        if self.verboseMode:
+            log.error(f"Received: {returnStr!r}")
+        if len(returnStr) == 0:
+            raise OSError("PMAC communication error: connection closed")
+        shortResponse = len(returnStr) < 1400
+        lastChar = returnStr[-1]
+        if shortResponse and lastChar == CHAR_RETURN:
+            # Error responses are passed up
+            pass
+        elif shortResponse and lastChar == CHAR_NULL:
+            raise OSError("Did not respond - PMAC busy or connection lost")
+        elif shortResponse and lastChar != CHAR_ACK:
+            raise OSError("PMAC communication error: unexpected terminator")
+        elif shortResponse and len(returnStr) > 1 and returnStr[-2] != CHAR_RETURN:
+            raise OSError("Truncated short response")
+        else:
+            # A long response is collected a buffer at a time
+            while lastChar not in VALID_ENDS:
+                self.writer.write(self.getbufferRequest)
+                await self.writer.drain()
+                more = await self.reader.read(2048)
+                if len(more) == 0 or (len(more) < 1400 and more[-1] == 0):
+                    raise OSError("Connection to PMAC lost")
+                returnStr += more.decode()
+                lastChar = returnStr[-1]
+            if lastChar == CHAR_RETURN:
+                raise OSError("PMAC communication error")
+            if len(returnStr) > 1 and returnStr[-2] != CHAR_RETURN:
+                returnStr = returnStr[:-1] + " WARNING: response truncated." + lastChar
+        return returnStr
+
+
+class AsyncPmacTelnetInterface(AsyncRemotePmacInterface):
+    """Asyncio connection to a PMAC through a terminal server, using the
+    same framing as dls_pmaclib's PmacTelnetInterface."""
+
+    lstRegExps = [
+        # 0: Error message
+        re.compile(rb"\aERR\d{3}\r"),
+        # 1: One hex number with leading $
+        re.compile(rb"^\$[A-Z0-9]+\r\x06"),
+        # 2: one decimal number possible sign and possible dot, followed by
+        # possible spaces
+        re.compile(rb"^-?(\d*\.)?\d+\s*\r\x06"),
+        # 3: return value of the status, position, velocity, fol. err command
+        re.compile(rb"^[A-Z0-9]+\r-?(\d*\.)?\d+\r-?(\d*\.)?\d+\r-?(\d*\.)?\d+\r\x06"),
+        # 4: everything else
+        re.compile(rb"\x06"),
+    ]
+
+    IAC = 255
+    DONT = 254
+    DO = 253
+    WONT = 252
+    WILL = 251
+    SB = 250
+    SE = 240
+
+    def __init__(self, verbose=False, timeout=3.0):
+        super().__init__(verbose, timeout)
+        self.rawq = b""
+        self.cookedq = b""
+
+    async def checkConnection(self):
+        # Check flow of serial comm with a basic "ver" command
+        _, status = await self.sendCommand("ver")
+        if not status:
+            await self.disconnect()
+            return (
+                "Error: did not get expected response from PMAC command "
+                '"ver".\n\nMaybe someone is connected to the port '
+                "already,\nor you are connecting to a wrong terminal "
+                "server port,\nor the port is mis-configured (e.g. wrong "
+                "baud rate)."
+            )
+        return None
+
+    def processTelnet(self, data):
+        """Strips telnet protocol sequences from the received data, refusing
+        any option negotiation in the same way as telnetlib."""
+        self.rawq += data
+        cooked = bytearray()
+        replies = bytearray()
+        i = 0
+        while i < len(self.rawq):
+            c = self.rawq[i]
+            if c != self.IAC:
+                cooked.append(c)
+                i += 1
+            elif i + 1 >= len(self.rawq):
+                break
+            elif self.rawq[i + 1] == self.IAC:
+                cooked.append(self.IAC)
+                i += 2
+            elif self.rawq[i + 1] in (self.DO, self.DONT, self.WILL, self.WONT):
+                if i + 2 >= len(self.rawq):
+                    break
+                if self.rawq[i + 1] in (self.DO, self.DONT):
+                    replies += bytes([self.IAC, self.WONT, self.rawq[i + 2]])
+                else:
+                    replies += bytes([self.IAC, self.DONT, self.rawq[i + 2]])
+                i += 3
+            elif self.rawq[i + 1] == self.SB:
+                end = self.rawq.find(bytes([self.IAC, self.SE]), i + 2)
+                if end < 0:
+                    break
+                i = end + 2
+            else:
+                i += 2
+        self.rawq = self.rawq[i:]
+        self.cookedq += bytes(cooked)
+        if replies:
+            self.writer.write(bytes(replies))
+
+    async def _sendCommand(self, command):
+        # Discard any orphaned replies to previous commands
+        self.cookedq = b""
+        self.writer.write((command + "\r\n").encode("utf8"))
+        await self.writer.drain()
+        if self.verboseMode:
+            log.error(f"Sent out: {command!r}")
+        while True:
+            for regExp in self.lstRegExps:
+                match = regExp.search(self.cookedq)
+                if match:
+                    returnStr = self.cookedq[: match.end()]
+                    self.cookedq = self.cookedq[match.end() :]
+                    if self.verboseMode:
+                        log.error(f"Received: {returnStr!r}")
+                    return returnStr.decode("utf8")
+            data = await self.reader.read(2048)
+            if len(data) == 0:
+                raise OSError("Communication with PMAC broken: connection closed")
+            self.processTelnet(data)
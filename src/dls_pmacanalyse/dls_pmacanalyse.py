@@ -27,6 +27,10 @@ helpText = """
         -h, --help                print(the help text and exit
         --backup=<dir>            As config file 'backup' statement (see below)
         --comments                As config file 'comments' statement (see below)
+        --incremental             As config file 'incremental' statement (see below)
+        --record=<dir>            As config file 'record' statement (see below)
+        --replay=<dir>            As config file 'replay' statement (see below)
+        --replayrealtime          As config file 'replayrealtime' statement (see below)
         --resultsdir=<dir>        As config file 'resultsdir' statement (see below)
         --pmac=<name>             As config file 'pmac' statement (see below)
         --ts=<ip>:<port>          As config file 'ts' statement (see below)
@@ -36,10 +40,15 @@ helpText = """
         --compare=<varSpec>       As config file 'compare' statement (see below)
         --reference=<filename>    As config file 'reference' statement (see below)
         --include=<paths>         As config file 'include' statement (see below)
+        --cachedir=<dir>          As config file 'cachedir' statement (see below)
+        --nocache                 As config file 'nocache' statement (see below)
         --nofactorydefs           As config file 'nofactorydefs' statement (see below)
         --only=<name>             Only analyse the named pmac. There can be more than
                                   one of these.
         --macroics=<num>          As config file 'macroics' statement (see below)
+        --batchsize=<num>         As config file 'batchsize' statement (see below)
+        --smallbuffers            As config file 'smallbuffers' statement (see below)
+        --maxprogram=<num>        As config file 'maxprogram' statement (see below)
         --checkpositions          Prints a warning if motor positions change during
                                   readout
         --debug                   Turns on extra debug output
@@ -47,6 +56,11 @@ helpText = """
         --unfixfile=<file>        Generate a file that can be used to correct the
                                   reference
         --loglevel=<level>        set logging to error warning info or debug
+        --jobs=<num>              As config file 'jobs' statement (see below)
+        --parsejobs=<num>         As config file 'parsejobs' statement (see below)
+        --asyncio                 As config file 'asyncio' statement (see below)
+        --hostjobs=<num>          As config file 'hostjobs' statement (see below)
+        --pipeline                As config file 'pipeline' statement (see below)
 
   Config file syntax:
     resultsdir <dir>
@@ -66,6 +80,41 @@ helpText = """
       Write backup files in the specified directory.  Defaults to no backup written.
     comments
       Write comments into backup files.
+    incremental
+      Store a fingerprint of each program beside the backup files, and on the
+      next run only list the programs whose fingerprint has changed.  The
+      fingerprint covers the length and the first and last lines of a program,
+      so an edit elsewhere that keeps the length is not detected.  Needs a
+      backup directory.
+    record <dir>
+      Record every command sent to each PMAC, with its reply and timing, in
+      the file <dir>/<pmac>.session.gz.
+    replay <dir>
+      Read each PMAC by replaying the session recorded in <dir> instead of
+      connecting to the PMAC.
+    replayrealtime
+      Reproduce the recorded reply times when replaying a session, rather
+      than replaying at full speed.
+    jobs <num>
+      The number of PMACs whose hardware is read concurrently.  Defaults to
+      1.  The comparison and reports are still produced in configuration
+      order, so the results are the same as a sequential run.
+    parsejobs <num>
+      The number of processes that parse the reference and compare with
+      files.  Parsing is CPU bound, so this defaults to the number of CPUs;
+      use 1 to parse in the main process.
+    asyncio
+      Read the hardware using a single asyncio event loop rather than worker
+      threads.  The 'jobs' statement still limits how many PMACs are read at
+      once.
+    hostjobs <num>
+      With 'asyncio', the number of PMACs read at once through any one host
+      (e.g. a terminal server).  Defaults to no limit other than 'jobs'.
+    pipeline
+      Load the reference and compare with files in 'parsejobs' worker
+      processes while the hardware is being read.  A reference with inline expressions
+      that use hardware values is loaded again once the hardware has been
+      read.
     comparewith <pmcfile>
       Rather than reading the hardware, use this PMC file as
       the current PMAC state.
@@ -115,12 +164,39 @@ helpText = """
         filename = PMC file name
     include <paths>
       Colon seperated list of include pathnames for PMC file preprocessor
+    cachedir <dir>
+      Directory in which the parsed factory settings and the preprocessed
+      reference files are cached between runs.  A cached reference is used
+      until it or one of the files it includes changes.  The number of
+      variables read per range command learnt by the readout of a PMAC is
+      also kept, keyed on its address, and its next readout starts from it.
+      Defaults to $XDG_CACHE_HOME/dls-pmacanalyse or
+      ~/.cache/dls-pmacanalyse.  The cached factory settings are Python
+      pickles, which can run code when loaded, so the directory must be
+      private to the user.
+    nocache
+      Parse the factory settings and preprocess the reference files on every
+      run rather than caching them, and start every readout from the default
+      number of variables per range command.
     nofactorydefs
       Specifies that the factory defaults should not be used to initialise the
       the reference state before loading the reference PMC file.
     macroics <num>
       The number of macro ICs the PMAC has.  If not specified, the number
       is automatically determined.
+    batchsize <num>
+      The maximum number of single value queries (macrostation I variables,
+      axis definitions, feedrate overrides...) packed into one command line.
+      Defaults to 32, a value of 1 sends every query on its own.
+    smallbuffers
+      Read program listings in small blocks.  By default PMACs connected over
+      TCP/IP are listed in large blocks, falling back to small blocks if that
+      fails.  PMACs behind a terminal server always use small blocks.
+    maxprogram <num>
+      The highest motion program number to read, up to 32767.  Defaults to 255.
+      Every program up to this number is listed with a command of its own,
+      so the readout time grows linearly with it: 32767 costs about 32000
+      round trips to the PMAC.
   """
 
 
@@ -62,6 +62,16 @@ class ParserError(Exception):
         return f"[{self.fileName}:{self.line}] {self.message}"
 
 
+class UnresolvedExpressionError(Exception):
+    """Inline expression that cannot yet be resolved exception."""
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
 class GeneralError(Exception):
     """General error exception."""
 
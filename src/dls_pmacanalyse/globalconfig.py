@@ -1,17 +1,11 @@
 import getopt
 import logging
+import os
 import sys
 
 from dls_pmacanalyse.errors import ArgumentError, ConfigError
 from dls_pmacanalyse.pmac import Pmac
 from dls_pmacanalyse.pmacparser import PmacParser
-from dls_pmacanalyse.pmacvariables import (
-    PmacIVariable,
-    PmacMsIVariable,
-    PmacMVariable,
-    PmacPVariable,
-    PmacQVariable,
-)
 
 log = logging.getLogger(__name__)
 
@@ -25,14 +19,27 @@ class GlobalConfig:
         self.backupDir = None
         self.writeAnalysis = True
         self.comments = False
+        self.incremental = False
+        self.recordDir = None
+        self.replayDir = None
+        self.replayRealTime = False
         self.configFile = None
         self.resultsDir = "pmacAnalysis"
         self.onlyPmacs = None
         self.includePaths = None
+        self.cacheDir = os.path.join(
+            os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+            "dls-pmacanalyse",
+        )
         self.checkPositions = False
         self.debug = False
         self.fixfile = None
         self.unfixfile = None
+        self.jobs = 1
+        self.parseJobs = os.cpu_count() or 1
+        self.useAsyncio = False
+        self.hostJobs = None
+        self.pipeline = False
         self.pmacs: dict[str, Pmac] = {}
 
     def createOrGetPmac(self, name: str):
@@ -62,14 +69,28 @@ class GlobalConfig:
                     "nocompare=",
                     "only=",
                     "include=",
+                    "cachedir=",
+                    "nocache",
                     "nofactorydefs",
                     "macroics=",
                     "checkpositions",
                     "debug",
                     "comments",
+                    "incremental",
+                    "record=",
+                    "replay=",
+                    "replayrealtime",
                     "fixfile=",
                     "unfixfile=",
                     "loglevel=",
+                    "jobs=",
+                    "parsejobs=",
+                    "asyncio",
+                    "hostjobs=",
+                    "pipeline",
+                    "batchsize=",
+                    "smallbuffers",
+                    "maxprogram=",
                 ],
             )
         except getopt.GetoptError as err:
@@ -85,6 +106,14 @@ class GlobalConfig:
                 self.backupDir = a
             elif o == "--comments":
                 self.comments = True
+            elif o == "--incremental":
+                self.incremental = True
+            elif o == "--record":
+                self.recordDir = a
+            elif o == "--replay":
+                self.replayDir = a
+            elif o == "--replayrealtime":
+                self.replayRealTime = True
             elif o == "--pmac":
                 curPmac = self.createOrGetPmac(a)
                 curPmac.copyNoComparesFrom(globalPmac)
@@ -139,39 +168,59 @@ class GlobalConfig:
                 self.resultsDir = a
             elif o == "--nocompare":
                 parser = PmacParser(a, None)
-                (type, nodeList, start, count, increment) = parser.parseVarSpec()
-                while count > 0:
-                    var = self.makeVars(type, nodeList, start)
-                    if curPmac is None:
-                        globalPmac.setNoCompare(var)
-                    else:
-                        curPmac.setNoCompare(var)
-                    start += increment
-                    count -= 1
+                varSpec = parser.parseVarSpec()
+                if curPmac is None:
+                    globalPmac.setNoCompare(varSpec)
+                else:
+                    curPmac.setNoCompare(varSpec)
             elif o == "--compare":
                 if curPmac is None:
                     raise ArgumentError("No PMAC yet defined")
                 else:
                     parser = PmacParser(a, None)
-                    (type, nodeList, start, count, increment) = parser.parseVarSpec()
-                    while count > 0:
-                        var = self.makeVars(type, nodeList, start)
-                        curPmac.clearNoCompare(var)
-                        start += increment
-                        count -= 1
+                    curPmac.clearNoCompare(parser.parseVarSpec())
             elif o == "--only":
                 if self.onlyPmacs is None:
                     self.onlyPmacs = []
                 self.onlyPmacs.append(a)
             elif o == "--include":
                 self.includePaths = a
+            elif o == "--cachedir":
+                self.cacheDir = a
+            elif o == "--nocache":
+                self.cacheDir = None
             elif o == "--macroics":
                 if curPmac is None:
                     raise ArgumentError("No PMAC yet defined")
                 else:
                     curPmac.setNumMacroStationIcs(int(a))
+            elif o == "--batchsize":
+                if curPmac is None:
+                    raise ArgumentError("No PMAC yet defined")
+                else:
+                    curPmac.setBatchSize(self.parsePositiveInt(a, "Batch size"))
+            elif o == "--maxprogram":
+                if curPmac is None:
+                    raise ArgumentError("No PMAC yet defined")
+                else:
+                    curPmac.setMaxProgram(self.parseMaxProgram(a))
+            elif o == "--smallbuffers":
+                if curPmac is None:
+                    raise ArgumentError("No PMAC yet defined")
+                else:
+                    curPmac.setSmallBuffers()
             elif o == "--checkpositions":
                 self.checkPositions = True
+            elif o == "--jobs":
+                self.jobs = self.parsePositiveInt(a, "Number of jobs")
+            elif o == "--parsejobs":
+                self.parseJobs = self.parsePositiveInt(a, "Number of parse jobs")
+            elif o == "--asyncio":
+                self.useAsyncio = True
+            elif o == "--pipeline":
+                self.pipeline = True
+            elif o == "--hostjobs":
+                self.hostJobs = self.parsePositiveInt(a, "Number of host jobs")
             elif o == "--loglevel":
                 numeric_level = getattr(logging, str(a).upper(), None)
                 log.setLevel(numeric_level)
@@ -234,57 +283,93 @@ class GlobalConfig:
                     self.resultsDir = words[1]
                 elif words[0].lower() == "include" and len(words) == 2:
                     self.includePaths = words[1]
+                elif words[0].lower() == "cachedir" and len(words) == 2:
+                    self.cacheDir = words[1]
+                elif words[0].lower() == "nocache" and len(words) == 1:
+                    self.cacheDir = None
                 elif words[0].lower() == "backup" and len(words) == 2:
                     self.backupDir = words[1]
                 elif words[0].lower() == "comments" and len(words) == 1:
                     self.comments = True
+                elif words[0].lower() == "incremental" and len(words) == 1:
+                    self.incremental = True
+                elif words[0].lower() == "record" and len(words) == 2:
+                    self.recordDir = words[1]
+                elif words[0].lower() == "replay" and len(words) == 2:
+                    self.replayDir = words[1]
+                elif words[0].lower() == "replayrealtime" and len(words) == 1:
+                    self.replayRealTime = True
+                elif words[0].lower() == "jobs" and len(words) == 2:
+                    self.jobs = self.parsePositiveInt(words[1], "Number of jobs")
+                elif words[0].lower() == "parsejobs" and len(words) == 2:
+                    self.parseJobs = self.parsePositiveInt(
+                        words[1], "Number of parse jobs"
+                    )
+                elif words[0].lower() == "asyncio" and len(words) == 1:
+                    self.useAsyncio = True
+                elif words[0].lower() == "pipeline" and len(words) == 1:
+                    self.pipeline = True
+                elif words[0].lower() == "hostjobs" and len(words) == 2:
+                    self.hostJobs = self.parsePositiveInt(
+                        words[1], "Number of host jobs"
+                    )
                 elif words[0].lower() == "nocompare" and len(words) == 2:
                     parser = PmacParser([words[1]], None)
-                    (type, nodeList, start, count, increment) = parser.parseVarSpec()
-                    while count > 0:
-                        var = self.makeVars(type, nodeList, start)
-                        if curPmac is None:
-                            globalPmac.setNoCompare(var)
-                        else:
-                            curPmac.setNoCompare(var)
-                        start += increment
-                        count -= 1
+                    varSpec = parser.parseVarSpec()
+                    if curPmac is None:
+                        globalPmac.setNoCompare(varSpec)
+                    else:
+                        curPmac.setNoCompare(varSpec)
                 elif (
                     words[0].lower() == "compare"
                     and len(words) == 2
                     and curPmac is not None
                 ):
                     parser = PmacParser([words[1]], None)
-                    (type, nodeList, start, count, increment) = parser.parseVarSpec()
-                    while count > 0:
-                        var = self.makeVars(type, nodeList, start)
-                        curPmac.clearNoCompare(var)
-                        start += increment
-                        count -= 1
+                    curPmac.clearNoCompare(parser.parseVarSpec())
                 elif (
                     words[0].lower() == "macroics"
                     and len(words) == 2
                     and curPmac is not None
                 ):
                     curPmac.setNumMacroStationIcs(int(words[1]))
+                elif (
+                    words[0].lower() == "batchsize"
+                    and len(words) == 2
+                    and curPmac is not None
+                ):
+                    curPmac.setBatchSize(self.parsePositiveInt(words[1], "Batch size"))
+                elif (
+                    words[0].lower() == "maxprogram"
+                    and len(words) == 2
+                    and curPmac is not None
+                ):
+                    curPmac.setMaxProgram(self.parseMaxProgram(words[1]))
+                elif (
+                    words[0].lower() == "smallbuffers"
+                    and len(words) == 1
+                    and curPmac is not None
+                ):
+                    curPmac.setSmallBuffers()
                 else:
                     raise ConfigError(f"Unknown configuration: {repr(line)}")
 
-    def makeVars(self, varType, nodeList, n):
-        """Makes a variable of the correct type."""
-        result = []
-        if varType == "i":
-            result.append(PmacIVariable(n))
-        elif varType == "p":
-            result.append(PmacPVariable(n))
-        elif varType == "m":
-            result.append(PmacMVariable(n))
-        elif varType == "ms":
-            for ms in nodeList:
-                result.append(PmacMsIVariable(ms, n))
-        elif varType == "&":
-            for cs in nodeList:
-                result.append(PmacQVariable(cs, n))
-        else:
-            raise ConfigError(f"Cannot decode variable type {repr(varType)}")
+    def parsePositiveInt(self, text, descr):
+        """Returns the value of a setting that must be a positive integer."""
+        try:
+            result = int(text)
+        except ValueError:
+            result = 0
+        if result < 1:
+            raise ConfigError(f"{descr} must be a positive integer: {text}")
         return result
+
+    def parseMaxProgram(self, text):
+        """Returns the value of a maxprogram setting."""
+        n = self.parsePositiveInt(text, "Maximum program number")
+        if n > Pmac.maxProgramNumber:
+            raise ConfigError(
+                f"Maximum program number must not exceed {Pmac.maxProgramNumber}: "
+                f"{text}"
+            )
+        return n
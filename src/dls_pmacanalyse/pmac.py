@@ -1,9 +1,18 @@
+import json
 import logging
+import os
 import re
+import threading
+import time
 
 from dls_pmaclib.dls_pmacremote import PmacEthernetInterface, PmacTelnetInterface
 
+from dls_pmacanalyse.asyncinterface import (
+    AsyncPmacEthernetInterface,
+    AsyncPmacTelnetInterface,
+)
 from dls_pmacanalyse.errors import AnalyseError, PmacReadError
+from dls_pmacanalyse.pmaccolumns import PmacVariables
 from dls_pmacanalyse.pmacparser import PmacParser
 from dls_pmacanalyse.pmacprogram import (
     PmacCsAxisDef,
@@ -20,7 +29,16 @@ from dls_pmacanalyse.pmacvariables import (
     PmacMVariable,
     PmacPVariable,
     PmacQVariable,
+    PmacToken,
+)
+from dls_pmacanalyse.session import (
+    AsyncSessionPlayer,
+    AsyncSessionRecorder,
+    SessionPlayer,
+    SessionRecorder,
 )
+from dls_pmacanalyse.timing import ReadoutTiming
+from dls_pmacanalyse.variablesets import VariableSet
 
 log = logging.getLogger(__name__)
 
@@ -28,9 +46,35 @@ log = logging.getLogger(__name__)
 class Pmac:
     """A class that represents a single PMAC and its state."""
 
+    # Limits on packing several queries into one command line.  The reply
+    # to a packed line is kept within one Ethernet buffer, as a buffer that
+    # happens to end with a carriage return ends a longer reply early
+    defaultBatchSize = 32
+    maxCommandLength = 250
+    maxPackedReplyLength = 1350
+    # The highest motion program number read by default, and the highest
+    # that exists
+    defaultMaxProgram = 255
+    maxProgramNumber = 32767
+    # Limits on the number of variables read by a range command
+    initialBlockSize = 100
+    minBlockSize = 10
+    maxBlockSize = 2048
+    maxReplyLength = {False: 8192, True: 1350}
+    # Program listing window sizes, in words, for small and large buffer
+    # modes, and the longest reply allowed in small buffer mode
+    smallListingIncrement = 80
+    smallListingMaxLength = 1350
+    largeListingIncrement = 4096
+    # The window, in words, of the list commands packed together to probe
+    # programs, a quarter of a small buffer mode window
+    listingProbeIncrement = 20
+    # Format of the program fingerprint files used by incremental readouts
+    fingerprintVersion = 1
+
     def __init__(self, name):
         self.name = name
-        self.noCompare = PmacState("noCompare")
+        self.noCompare = VariableSet()
         self.reference = None
         self.compareWith = None
         self.host = ""
@@ -45,6 +89,24 @@ class Pmac:
         self.compareResult = True
         self.useFactoryDefs = True
         self.numAxes = 0
+        self.numCoordSystems = 0
+        self.batchSize = Pmac.defaultBatchSize
+        self.maxProgram = Pmac.defaultMaxProgram
+        self.smallBuffers = False
+        self.largeListings = False
+        self.fingerprintFileName = None
+        self.cachedListings = {}
+        self.listings = {}
+        self.recordFile = None
+        self.replayFile = None
+        self.replayRealTime = False
+        # The range command block sizes learnt for each kind of variable,
+        # starting from those saved by the last readout of the PMAC at the
+        # same address.  A recording keeps the sizes it started from so that
+        # it replays.
+        self.blockSizes = {}
+        self.blockSizeFileName = None
+        self.timing = ReadoutTiming()
         self.positionsBefore = []
         self.positionsAfter = []
 
@@ -91,6 +153,25 @@ class Pmac:
     def setNumMacroStationIcs(self, n):
         self.numMacroStationIcs = n
 
+    def setBatchSize(self, n):
+        self.batchSize = n
+
+    def setMaxProgram(self, n):
+        self.maxProgram = n
+
+    def setSmallBuffers(self):
+        self.smallBuffers = True
+
+    def setRecordFile(self, fileName):
+        self.recordFile = fileName
+
+    def setReplayFile(self, fileName, realTime=False):
+        self.replayFile = fileName
+        self.replayRealTime = realTime
+
+    def setBlockSizeFile(self, fileName):
+        self.blockSizeFileName = fileName
+
     def setNoFactoryDefs(self):
         self.useFactoryDefs = False
 
@@ -100,67 +181,47 @@ class Pmac:
     def setCompareWith(self, compareWith):
         self.compareWith = compareWith
 
-    def setNoCompare(self, vars):
-        for var in vars:
-            self.noCompare.addVar(var)
+    def setNoCompare(self, varSpec):
+        """Excludes the variables of a parsed variable specification from the
+        compare."""
+        self.noCompare.add(*varSpec)
 
-    def clearNoCompare(self, vars):
-        for var in vars:
-            self.noCompare.removeVar(var)
+    def clearNoCompare(self, varSpec):
+        """Includes the variables of a parsed variable specification in the
+        compare again."""
+        self.noCompare.remove(*varSpec)
 
     def copyNoComparesFrom(self, otherPmac):
-        self.noCompare.copyFrom(otherPmac.noCompare)
+        self.noCompare.update(otherPmac.noCompare)
 
-    def readHardware(self, backupDir, checkPositions, debug, comments, verbose):
+    def readHardware(
+        self, backupDir, checkPositions, debug, comments, verbose, incremental=False
+    ):
         """Loads the current state of the PMAC.  If a backupDir is provided, the
         state is written as it is read."""
-        self.checkPositions = checkPositions
-        self.debug = debug
-        self.comments = comments
         try:
-            # Open the backup file if required
-            if backupDir is not None:
-                fileName = f"{backupDir}/{self.name}.pmc"
-                log.info(f"Opening backup file {fileName}")
-                self.backupFile = open(fileName, "w")
-                if self.backupFile is None:
-                    raise AnalyseError(f"Could not open backup file: {fileName}")
+            self.startReadout(backupDir, checkPositions, debug, comments, incremental)
             # Open either a Telnet connection to a terminal server,
-            # or a direct TCP/IP connection to a PMAC
-            if self.termServ:
+            # or a direct TCP/IP connection to a PMAC, or replay a
+            # recorded session
+            if self.replayFile is not None:
+                self.pti = SessionPlayer(self.replayFile, self.replayRealTime)
+            elif self.termServ:
                 self.pti = PmacTelnetInterface(verbose=verbose)
             else:
                 self.pti = PmacEthernetInterface(verbose=verbose)
+            if self.recordFile is not None:
+                self.pti = SessionRecorder(self.pti, self.recordFile, self.blockSizes)
             self.pti.setConnectionParams(self.host, self.port)
             msg = self.pti.connect()
             if msg is not None:
                 raise PmacReadError(msg)
+            if self.replayFile is not None:
+                self.blockSizes = dict(self.pti.blockSizes)
             log.warning(
                 'Connected to a PMAC via "%s" using port %s.', self.host, self.port
             )
-            # Work out what kind of PMAC we have, if necessary
-            self.determinePmacType()
-            self.determineNumAxes()
-            self.determineNumCoordSystems()
-            # Read the axis current positions
-            self.positionsBefore = self.readCurrentPositions()
-            log.debug("Current positions: %s", self.positionsBefore)
-            # Read the data
-            self.readCoordinateSystemDefinitions()
-            self.readMotionPrograms()
-            self.readKinematicPrograms()
-            self.readPlcPrograms()
-            self.readPvars()
-            self.readQvars()
-            self.readFeedrateOverrides()
-            self.readIvars()
-            self.readMvarDefinitions()
-            self.readMvarValues()
-            self.readMsIvars()
-            self.readGlobalMsIvars()
-            self.readPlcDisableState()
-            self.verifyCurrentPositions(self.positionsBefore)
-            # Read the current axis positions again
+            self.runCommands(self.readout())
         finally:
             # Disconnect from the PMAC
             if self.pti is not None:
@@ -168,15 +229,208 @@ class Pmac:
                 msg = self.pti.disconnect()
                 self.pti = None
                 log.info("Connection to the PMAC closed.")
-            # Close the backup file
-            if self.backupFile is not None:
-                self.backupFile.close()
-                self.backupFile = None
+            self.finishReadout()
+
+    async def readHardwareAsync(
+        self, backupDir, checkPositions, debug, comments, verbose, incremental=False
+    ):
+        """The asyncio counterpart of readHardware.  The same readout is
+        performed, but over an asyncio transport so that many PMACs can be
+        read by a single event loop."""
+        try:
+            self.startReadout(backupDir, checkPositions, debug, comments, incremental)
+            if self.replayFile is not None:
+                self.pti = AsyncSessionPlayer(self.replayFile, self.replayRealTime)
+            elif self.termServ:
+                self.pti = AsyncPmacTelnetInterface(verbose=verbose)
+            else:
+                self.pti = AsyncPmacEthernetInterface(verbose=verbose)
+            if self.recordFile is not None:
+                self.pti = AsyncSessionRecorder(
+                    self.pti, self.recordFile, self.blockSizes
+                )
+            self.pti.setConnectionParams(self.host, self.port)
+            msg = await self.pti.connect()
+            if msg is not None:
+                raise PmacReadError(msg)
+            if self.replayFile is not None:
+                self.blockSizes = dict(self.pti.blockSizes)
+            log.warning(
+                'Connected to a PMAC via "%s" using port %s.', self.host, self.port
+            )
+            await self.runCommandsAsync(self.readout())
+        finally:
+            if self.pti is not None:
+                log.info("Disconnecting from PMAC...")
+                await self.pti.disconnect()
+                self.pti = None
+                log.info("Connection to the PMAC closed.")
+            self.finishReadout()
+
+    def startReadout(
+        self, backupDir, checkPositions, debug, comments, incremental=False
+    ):
+        """Prepares for a hardware readout, opening the backup file if a
+        backupDir is provided.  For an incremental readout the program
+        fingerprints stored beside the backup by the previous readout are
+        loaded, as are the block sizes saved by the previous readout."""
+        self.checkPositions = checkPositions
+        self.debug = debug
+        self.comments = comments
+        # Large program listings rely on the TCP/IP transport collecting
+        # replies that span several buffers.  Terminal servers always use
+        # small buffer mode.
+        self.largeListings = not self.termServ and not self.smallBuffers
+        self.fingerprintFileName = None
+        self.cachedListings = {}
+        self.listings = {}
+        self.blockSizes = {}
+        if self.blockSizeFileName is not None and self.replayFile is None:
+            self.blockSizes = self.loadBlockSizes(self.blockSizeFileName)
+        self.timing.start()
+        if backupDir is not None and incremental:
+            self.fingerprintFileName = f"{backupDir}/{self.name}.fingerprints.json"
+            self.cachedListings = self.loadFingerprints(self.fingerprintFileName)
+        if backupDir is not None:
+            fileName = f"{backupDir}/{self.name}.pmc"
+            log.info(f"Opening backup file {fileName}")
+            self.backupFile = open(fileName, "w")
+            if self.backupFile is None:
+                raise AnalyseError(f"Could not open backup file: {fileName}")
+
+    def loadFingerprints(self, fileName):
+        """Returns the program listings stored by a previous incremental
+        readout, keyed by list command.  A missing or unreadable file, or one
+        written in another format, gives an empty cache."""
+        if not os.path.exists(fileName):
+            return {}
+        try:
+            with open(fileName) as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring fingerprint file {fileName}: {e}")
+            return {}
+        if not isinstance(data, dict) or data.get("version") != Pmac.fingerprintVersion:
+            log.warning(f"Ignoring fingerprint file {fileName}: unknown format")
+            return {}
+        return data.get("listings", {})
+
+    def writeFingerprints(self):
+        """Stores the fingerprints and listings of the programs read, for use
+        by the next incremental readout."""
+        if self.fingerprintFileName is not None:
+            log.info(f"Writing fingerprint file {self.fingerprintFileName}")
+            with open(self.fingerprintFileName, "w") as file:
+                json.dump(
+                    {"version": Pmac.fingerprintVersion, "listings": self.listings},
+                    file,
+                )
+
+    def loadBlockSizes(self, fileName):
+        """Returns the block sizes saved by a previous readout, keyed by kind
+        of variable.  A missing or unreadable file gives no sizes."""
+        if not os.path.exists(fileName):
+            return {}
+        try:
+            with open(fileName) as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring block size file {fileName}: {e}")
+            return {}
+        if not isinstance(data, dict):
+            log.warning(f"Ignoring block size file {fileName}: unknown format")
+            return {}
+        return {
+            key: size
+            for key, size in data.items()
+            if isinstance(size, int) and Pmac.minBlockSize <= size <= Pmac.maxBlockSize
+        }
+
+    def writeBlockSizes(self, fileName):
+        """Saves the learnt block sizes for the next readout.  Failing to
+        save them is not an error."""
+        try:
+            os.makedirs(os.path.dirname(fileName), exist_ok=True)
+            tmpFile = f"{fileName}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmpFile, "w") as file:
+                json.dump(self.blockSizes, file)
+            os.replace(tmpFile, fileName)
+        except OSError as e:
+            log.warning(f"Could not write block size file {fileName}: {e}")
+
+    def finishReadout(self):
+        """Tidies up after a hardware readout, saving the learnt block sizes
+        unless the readout was a replay."""
+        self.timing.stop()
+        if self.blockSizeFileName is not None and self.replayFile is None:
+            self.writeBlockSizes(self.blockSizeFileName)
+        # Close the backup file
+        if self.backupFile is not None:
+            self.backupFile.close()
+            self.backupFile = None
+
+    def readout(self):
+        """Reads the state of the PMAC.  This, and each of the read functions
+        it uses, is a generator that yields the commands to send to the PMAC
+        and is sent back each (returnStr, status) reply.  This keeps the
+        readout independent of the transport so that it can be driven by
+        either runCommands or runCommandsAsync."""
+        # Work out what kind of PMAC we have, if necessary
+        yield from self.timed(self.determineConfiguration())
+        # Read the axis current positions
+        self.positionsBefore = yield from self.timed(self.readCurrentPositions())
+        log.debug("Current positions: %s", self.positionsBefore)
+        # Read the data
+        yield from self.timed(self.readCoordinateSystemDefinitions())
+        yield from self.timed(self.readMotionPrograms())
+        yield from self.timed(self.readKinematicPrograms())
+        yield from self.timed(self.readPlcPrograms())
+        yield from self.timed(self.readPvars())
+        yield from self.timed(self.readQvars())
+        yield from self.timed(self.readFeedrateOverrides())
+        yield from self.timed(self.readIvars())
+        yield from self.timed(self.readMvarDefinitions())
+        yield from self.timed(self.readMvarValues())
+        yield from self.timed(self.readMsIvars())
+        yield from self.timed(self.readGlobalMsIvars())
+        yield from self.timed(self.readPlcDisableState())
+        # Read the current axis positions again
+        yield from self.timed(self.verifyCurrentPositions(self.positionsBefore))
+        self.writeFingerprints()
+
+    def timed(self, commands):
+        """Runs a command generator as a phase of the readout timing, named
+        after the generator function."""
+        self.timing.enterPhase(commands.__name__)
+        try:
+            return (yield from commands)
+        finally:
+            self.timing.exitPhase()
+
+    def runCommands(self, commands):
+        """Drives a command generator using the blocking transport, returning
+        the generator's result."""
+        try:
+            command = next(commands)
+            while True:
+                command = commands.send(self.sendCommand(command))
+        except StopIteration as e:
+            return e.value
+
+    async def runCommandsAsync(self, commands):
+        """Drives a command generator using the asyncio transport, returning
+        the generator's result."""
+        try:
+            command = next(commands)
+            while True:
+                command = commands.send(await self.sendCommandAsync(command))
+        except StopIteration as e:
+            return e.value
 
     def verifyCurrentPositions(self, positions):
         """Checks the axis current positions to see if any have moved."""
         if self.checkPositions:
-            now = self.readCurrentPositions()
+            now = yield from self.readCurrentPositions()
             match = True
             for i in range(len(now)):
                 if (
@@ -195,25 +449,115 @@ class Pmac:
                 log.warning(f"  Now:    {now}")
 
     def sendCommand(self, text):
+        start = time.perf_counter()
         (returnStr, status) = self.pti.sendCommand(text)
+        self.timing.addCommand(time.perf_counter() - start, len(text), len(returnStr))
         # log.debug('%s --> %s', repr(text), repr(returnStr))
         return (returnStr, status)
 
+    async def sendCommandAsync(self, text):
+        start = time.perf_counter()
+        (returnStr, status) = await self.pti.sendCommand(text)
+        self.timing.addCommand(time.perf_counter() - start, len(text), len(returnStr))
+        return (returnStr, status)
+
+    def queryBatch(self, commands):
+        """Sends a list of independent query commands, each of which returns a
+        single line, packing several into each command line to save round
+        trips.  Returns a list of (returnStr, status) in which each reply has
+        the form it would have had if its command had been sent on its own.
+        When a packed line produces an error the answers before the error are
+        kept and the failing command is sent on its own.  If that succeeds the
+        PMAC objected to the packing itself and the remaining commands are
+        sent one at a time, otherwise the batch size is halved to limit the
+        cost of a run of errors (e.g. a missing macro station), growing again
+        as queries succeed."""
+        replies = []
+        batchSize = self.batchSize
+        packingFailed = False
+        i = 0
+        while i < len(commands):
+            # Pack the next batch within the command line limit
+            batch = [commands[i]]
+            length = len(commands[i])
+            while (
+                i + len(batch) < len(commands)
+                and len(batch) < batchSize
+                and length + 1 + len(commands[i + len(batch)]) <= self.maxCommandLength
+            ):
+                length += 1 + len(commands[i + len(batch)])
+                batch.append(commands[i + len(batch)])
+            if len(batch) == 1:
+                (returnStr, status) = yield batch[0]
+                replies.append((returnStr, status))
+                i += 1
+                if status and "\x07" not in returnStr and not packingFailed:
+                    batchSize = min(self.batchSize, batchSize * 2)
+                continue
+            (returnStr, status) = yield " ".join(batch)
+            answers = returnStr.split("\r")
+            if (
+                status
+                and "\x07" not in returnStr
+                and returnStr.endswith("\r\x06")
+                and len(answers) == len(batch) + 1
+            ):
+                replies += [(f"{answer}\r\x06", True) for answer in answers[:-1]]
+                i += len(batch)
+                batchSize = min(self.batchSize, batchSize * 2)
+            elif status and "\x07" in returnStr:
+                good = returnStr[: returnStr.index("\x07")].split("\r")[:-1]
+                if len(good) >= len(batch):
+                    good = []
+                replies += [(f"{answer}\r\x06", True) for answer in good]
+                (returnStr, status) = yield batch[len(good)]
+                replies.append((returnStr, status))
+                if status and "\x07" not in returnStr:
+                    packingFailed = True
+                    batchSize = 1
+                else:
+                    batchSize = max(1, batchSize // 2)
+                i += len(good) + 1
+            else:
+                for command in batch:
+                    replies.append((yield command))
+                i += len(batch)
+        return replies
+
     def readCurrentPositions(self):
         """Returns the current position as a list."""
         positions = []
-        for axis in range(self.numAxes):
-            (returnStr, status) = self.sendCommand("#%sP" % (axis + 1))
+        replies = yield from self.queryBatch(
+            ["#%sP" % (axis + 1) for axis in range(self.numAxes)]
+        )
+        for returnStr, _ in replies:
             positions.append(float(returnStr[:-2]))
         return positions
 
-    def determinePmacType(self):
-        """Discovers whether the PMAC is a Geobrick or a VME style PMAC"""
+    def determineConfiguration(self):
+        """Works out whatever is not already configured of the kind of PMAC,
+        its number of axes and its number of coordinate systems, sending the
+        queries together."""
+        queries = []
         if self.geobrick is None:
-            (returnStr, status) = self.sendCommand("cid")
+            queries.append("cid")
+        if self.numMacroStationIcs is None:
+            queries += ["i20", "i21", "i22", "i23"]
+        queries.append("i68")
+        replies = yield from self.queryBatch(queries)
+        answers = {}
+        for query, (returnStr, status) in zip(queries, replies, strict=True):
             if not status:
                 raise PmacReadError(returnStr)
-            id = returnStr[:-2]
+            answers[query] = returnStr[:-2]
+        self.determinePmacType(answers.get("cid"))
+        self.determineNumAxes([answers.get(f"i{i}") for i in range(20, 24)])
+        self.determineNumCoordSystems(answers["i68"])
+
+    def determinePmacType(self, id):
+        """Discovers whether the PMAC is a Geobrick or a VME style PMAC from
+        its card id"""
+        if self.geobrick is None:
             if id == "602413":
                 self.geobrick = False
             elif id == "603382":
@@ -222,14 +566,10 @@ class Pmac:
                 self.geobrick = False
             log.warning(f"Geobrick= {self.geobrick}")
 
-    def determineNumAxes(self):
+    def determineNumAxes(self, macroIcAddresses):
         """Determines the number of axes the PMAC has by determining the
-        number of macro station ICs."""
+        number of macro station ICs from their addresses, i20..i23."""
         if self.numMacroStationIcs is None:
-            (returnStr, status) = self.sendCommand("i20 i21 i22 i23")
-            if not status:
-                raise PmacReadError(returnStr)
-            macroIcAddresses = returnStr[:-2].split("\r")
             self.numMacroStationIcs = 0
             for i in range(4):
                 if macroIcAddresses[i] != "$0":
@@ -239,13 +579,10 @@ class Pmac:
             self.numAxes += 8
         log.info(f"Num axes= {self.numAxes}")
 
-    def determineNumCoordSystems(self):
-        """Determines the number of coordinate systems that are active by
-        reading i68."""
-        (returnStr, status) = self.sendCommand("i68")
-        if not status:
-            raise PmacReadError(returnStr)
-        self.numCoordSystems = int(returnStr[:-2]) + 1
+    def determineNumCoordSystems(self, i68):
+        """Determines the number of coordinate systems that are active from
+        i68."""
+        self.numCoordSystems = int(i68) + 1
 
     def writeBackup(self, text):
         """If a backup file is open, write the text."""
@@ -294,38 +631,74 @@ class Pmac:
                 6612,
             ]
         )
-        varsPerBlock = 100
+        ivars = yield from self.readRange("i")
+        for n, x in enumerate(ivars):
+            ro = n in roVars
+            var = PmacIVariable(n, self.toNumber(x), ro=ro)
+            self.hardwareState.addVar(var)
+            motor = n / 100
+            index = n % 100
+            text = ""
+            if self.comments:
+                if motor == 0 and index in PmacState.globalIVariableDescriptions:
+                    text = PmacState.globalIVariableDescriptions[index]
+                if (
+                    motor >= 1
+                    and motor <= 32
+                    and index in PmacState.motorIVariableDescriptions
+                ):
+                    text = PmacState.motorIVariableDescriptions[index]
+            self.writeBackup(var.dump(comment=text))
+
+    def readRange(self, prefix, suffix="", count=8192):
+        """Reads the variables prefix0..prefix<count-1>, returning a list of
+        the reply strings.  The number of variables requested per command
+        adapts to the link: it grows while replies come back intact and well
+        within the reply length limit and is halved when a reply is an error,
+        truncated or over the limit, after which it never grows back to the
+        failing size.  The final size is kept for the kind of variable, the
+        next read of which starts from it, in this readout or the next."""
+        key = prefix + suffix
+        blockSize = self.blockSizes.get(key, Pmac.initialBlockSize)
+        maxReplyLength = Pmac.maxReplyLength[self.termServ]
+        ceiling = Pmac.maxBlockSize + 1
+        failures = 0
+        result = []
         i = 0
-        while i < 8192:
-            iend = i + varsPerBlock - 1
-            if iend >= 8192:
-                iend = 8191
-            (returnStr, status) = self.sendCommand(f"i{i}..{iend}")
-            if not status:
-                raise PmacReadError(returnStr)
-            ivars = enumerate(returnStr.split("\r")[:-1])
-            for o, x in ivars:
-                ro = i + o in roVars
-                var = PmacIVariable(i + o, self.toNumber(x), ro=ro)
-                self.hardwareState.addVar(var)
-                motor = (i + o) / 100
-                index = (i + o) % 100
-                text = ""
-                if self.comments:
-                    if motor == 0 and index in PmacState.globalIVariableDescriptions:
-                        text = PmacState.globalIVariableDescriptions[index]
-                    if (
-                        motor >= 1
-                        and motor <= 32
-                        and index in PmacState.motorIVariableDescriptions
-                    ):
-                        text = PmacState.motorIVariableDescriptions[index]
-                self.writeBackup(var.dump(comment=text))
-            i += varsPerBlock
+        while i < count:
+            iend = min(i + blockSize, count) - 1
+            (returnStr, status) = yield f"{prefix}{i}..{iend}{suffix}"
+            values = returnStr.split("\r")
+            if (
+                status
+                and returnStr.endswith("\r\x06")
+                and "\x07" not in returnStr
+                and "WARNING: response truncated" not in returnStr
+                and len(values) == iend - i + 2
+            ):
+                result += values[:-1]
+                i = iend + 1
+                failures = 0
+                if len(returnStr) > maxReplyLength:
+                    ceiling = blockSize
+                    blockSize = max(Pmac.minBlockSize, blockSize // 2)
+                elif len(returnStr) * 2 < maxReplyLength and iend + 1 < count:
+                    blockSize = min(blockSize * 2, (blockSize + ceiling) // 2)
+            else:
+                # Try again with a smaller block, unless there is no smaller
+                # block or the connection keeps failing
+                failures += 1
+                if blockSize <= Pmac.minBlockSize or failures > 3:
+                    raise PmacReadError(returnStr)
+                log.debug(f"Range read failed: {returnStr!r}, reducing block size")
+                ceiling = blockSize
+                blockSize = max(Pmac.minBlockSize, blockSize // 2)
+        self.blockSizes[key] = blockSize
+        return result
 
     def readPlcDisableState(self):
         """Reads the PLC disable state from the M variables 5000..5031."""
-        (returnStr, status) = self.sendCommand("m5000..5031")
+        (returnStr, status) = yield "m5000..5031"
         if not status:
             raise PmacReadError(returnStr)
         mvars = enumerate(returnStr.split("\r")[:-1])
@@ -341,42 +714,57 @@ class Pmac:
         """Reads the P variables."""
         log.info("Reading P-variables...")
         self.writeBackup("\n; P-variables\n")
-        varsPerBlock = 100
-        i = 0
-        while i < 8192:
-            iend = i + varsPerBlock - 1
-            if iend >= 8192:
-                iend = 8191
-            (returnStr, status) = self.sendCommand(f"p{i}..{iend}")
-            if not status:
-                raise PmacReadError(returnStr)
-            pvars = enumerate(returnStr.split("\r")[:-1])
-            for o, x in pvars:
-                var = PmacPVariable(i + o, self.toNumber(x))
-                self.hardwareState.addVar(var)
-                self.writeBackup(var.dump())
-            i += varsPerBlock
+        pvars = yield from self.readRange("p")
+        for n, x in enumerate(pvars):
+            var = PmacPVariable(n, self.toNumber(x))
+            self.hardwareState.addVar(var)
+            self.writeBackup(var.dump())
 
     def readQvars(self):
-        """Reads the Q variables of a coordinate system."""
+        """Reads the Q variables of the coordinate systems.  After the first
+        coordinate system the reads of as many coordinate systems as keep the
+        reply within the packed reply limit are packed into each command
+        line, going back to one at a time if a packed reply is not intact."""
         log.info("Reading Q-variables...")
-        for cs in range(1, self.numCoordSystems + 1):
-            self.writeBackup(f"\n; &{cs} Q-variables\n")
-            (returnStr, status) = self.sendCommand(f"&{cs}q1..199")
+        perLine = 1
+        packingFailed = False
+        cs = 1
+        while cs <= self.numCoordSystems:
+            css = range(cs, min(cs + perLine, self.numCoordSystems + 1))
+            (returnStr, status) = yield " ".join(f"&{c}q1..199" for c in css)
+            values = returnStr.split("\r")[:-1]
+            if len(css) > 1 and (
+                not status
+                or "\x07" in returnStr
+                or not returnStr.endswith("\r\x06")
+                or len(values) != 199 * len(css)
+            ):
+                packingFailed = True
+                perLine = 1
+                continue
             if not status:
                 raise PmacReadError(returnStr)
-            qvars = enumerate(returnStr.split("\r")[:-1])
-            for o, x in qvars:
-                var = PmacQVariable(cs, o + 1, self.toNumber(x))
-                self.hardwareState.addVar(var)
-                self.writeBackup(var.dump())
+            for c in css:
+                self.writeBackup(f"\n; &{c} Q-variables\n")
+                qvars = enumerate(values[(c - cs) * 199 : (c - cs + 1) * 199])
+                for o, x in qvars:
+                    var = PmacQVariable(c, o + 1, self.toNumber(x))
+                    self.hardwareState.addVar(var)
+                    self.writeBackup(var.dump())
+            cs += len(css)
+            if not packingFailed:
+                perLine = max(
+                    1, Pmac.maxPackedReplyLength * len(css) // max(1, len(returnStr))
+                )
 
     def readFeedrateOverrides(self):
         """Reads the feedrate overrides of the coordinate systems."""
         log.info("Reading feedrate overrides...")
         self.writeBackup("\n; Feedrate overrides\n")
-        for cs in range(1, self.numCoordSystems + 1):
-            (returnStr, status) = self.sendCommand(f"&{cs}%")
+        replies = yield from self.queryBatch(
+            [f"&{cs}%" for cs in range(1, self.numCoordSystems + 1)]
+        )
+        for cs, (returnStr, status) in enumerate(replies, 1):
             if not status:
                 raise PmacReadError(returnStr)
             val = returnStr.split("\r")[0]
@@ -388,98 +776,242 @@ class Pmac:
         """Reads the M variable definitions."""
         log.info("Reading M-variable definitions...")
         self.writeBackup("\n; M-variables\n")
-        varsPerBlock = 100
-        i = 0
-        while i < 8192:
-            iend = i + varsPerBlock - 1
-            if iend >= 8192:
-                iend = 8191
-            (returnStr, status) = self.sendCommand(f"m{i}..{iend}->")
-            if not status:
-                raise PmacReadError(returnStr)
-            mvars = enumerate(returnStr.split("\r")[:-1])
-            for o, x in mvars:
-                var = PmacMVariable(i + o)
-                parser = PmacParser([x], self)
-                parser.parseMVariableAddress(variable=var)
-                self.hardwareState.addVar(var)
-                self.writeBackup(var.dump())
-            i += varsPerBlock
+        mvars = yield from self.readRange("m", "->")
+        for n, x in enumerate(mvars):
+            var = PmacMVariable(n)
+            parser = PmacParser([x], self)
+            parser.parseMVariableAddress(variable=var)
+            self.hardwareState.addVar(var)
+            self.writeBackup(var.dump())
 
     def readMvarValues(self):
         """Reads the M variable values."""
         log.info("Reading M-variable values...")
-        varsPerBlock = 100
-        i = 0
-        while i < 8192:
-            iend = i + varsPerBlock - 1
-            if iend >= 8192:
-                iend = 8191
-            (returnStr, status) = self.sendCommand(f"m{i}..{iend}")
-            if not status:
-                raise PmacReadError(returnStr)
-            mvars = enumerate(returnStr.split("\r")[:-1])
-            for o, x in mvars:
-                var = self.hardwareState.getMVariable(i + o)
-                var.setValue(self.toNumber(x))
-                # if (i+o) == 99:
-                #    print("m99 ->%s, =%s, x=%s" % (var.valStr(), var.contentsStr(), x)
-            i += varsPerBlock
+        mvars = yield from self.readRange("m")
+        for n, x in enumerate(mvars):
+            var = self.hardwareState.getMVariable(n)
+            var.setValue(self.toNumber(x))
+            # if n == 99:
+            #    print("m99 ->%s, =%s, x=%s" % (var.valStr(), var.contentsStr(), x)
 
     def readCoordinateSystemDefinitions(self):
         """Reads the coordinate system definitions."""
         log.info("Reading coordinate system definitions...")
         self.writeBackup("\n; Coordinate system definitions\n")
         self.writeBackup("undefine all\n")
-        for cs in range(1, self.numCoordSystems + 1):
-            for axis in range(1, 32 + 1):  # Note range is always 32 NOT self.numAxes
-                # Ask for the motor status in the coordinate system
-                cmd = f"&{cs}#{axis}->"
-                (returnStr, status) = self.sendCommand(cmd)
-                if not status or len(returnStr) <= 2:
-                    raise PmacReadError(returnStr)
-                # Note the dropping of the last two characters, ^m^f
-                parser = PmacParser([returnStr[:-2]], self)
-                var = PmacCsAxisDef(cs, axis, parser.tokens())
-                self.hardwareState.addVar(var)
-                self.writeBackup(var.dump())
+        # Ask for the motor status in the coordinate system
+        # Note range is always 32 NOT self.numAxes
+        axes = [
+            (cs, axis)
+            for cs in range(1, self.numCoordSystems + 1)
+            for axis in range(1, 32 + 1)
+        ]
+        replies = yield from self.queryBatch([f"&{cs}#{axis}->" for cs, axis in axes])
+        for (cs, axis), (returnStr, status) in zip(axes, replies, strict=True):
+            if not status or len(returnStr) <= 2:
+                raise PmacReadError(returnStr)
+            # Note the dropping of the last two characters, ^m^f
+            parser = PmacParser([returnStr[:-2]], self)
+            var = PmacCsAxisDef(cs, axis, parser.tokens())
+            self.hardwareState.addVar(var)
+            self.writeBackup(var.dump())
 
     def readKinematicPrograms(self):
-        """Reads the kinematic programs.  Note that this
-        function will fail if a program exceeds 1350 characters and small buffers
-        are required."""
+        """Reads the kinematic programs."""
         log.info("Reading kinematic programs...")
         self.writeBackup("\n; Kinematic programs\n")
-        for cs in range(1, self.numCoordSystems + 1):
-            lines, _ = self.getListingLines("forward", f"&{cs}")
+        css = range(1, self.numCoordSystems + 1)
+        listings = yield from self.readListings(
+            [(kind, f"&{cs}") for cs in css for kind in ("forward", "inverse")]
+        )
+        for index, (tokens, lines, _) in enumerate(listings):
             if len(lines) > 0:
-                parser = PmacParser(lines, self)
-                var = PmacForwardKinematicProgram(cs, parser.tokens())
+                cs = css[index // 2]
+                if index % 2 == 0:
+                    var = PmacForwardKinematicProgram(cs, tokens)
+                else:
+                    var = PmacInverseKinematicProgram(cs, tokens)
                 self.hardwareState.addVar(var)
                 self.writeBackup(var.dump())
 
-            lines, _ = self.getListingLines("inverse", f"&{cs}")
-            if len(lines) > 0:
-                parser = PmacParser(lines, self)
-                var = PmacInverseKinematicProgram(cs, parser.tokens())
-                self.hardwareState.addVar(var)
-                self.writeBackup(var.dump())
+    def fingerprintCommand(self, thing, pre_thing, offsets):
+        """Returns the command whose reply fingerprints a program listing: its
+        first line and its last line, which also locates the end of the
+        program."""
+        return f"{pre_thing}list {thing},0,1 {pre_thing}list {thing},{offsets[-1]},1"
+
+    def readListings(self, listings):
+        """Returns the tokens, lines and offsets of each of a list of programs
+        given as (thing, pre_thing) pairs.  The programs that have no stored
+        listing to check are first probed together."""
+        unstored = [
+            (thing, pre_thing)
+            for thing, pre_thing in listings
+            if f"{pre_thing}list {thing}" not in self.cachedListings
+        ]
+        probes = yield from self.probeListings(unstored)
+        probes = dict(zip(unstored, probes, strict=True))
+        result = []
+        for thing, pre_thing in listings:
+            probe = probes.get((thing, pre_thing))
+            result.append((yield from self.readListing(thing, pre_thing, probe)))
+        return result
+
+    def probeListings(self, listings):
+        """Lists the first few words of each of a list of programs given as
+        (thing, pre_thing) pairs, packing as many list commands into each
+        command line as keep the reply within the packed reply limit.  The
+        PMAC ignores the rest of a line after an error, so every undefined
+        program still costs a round trip, but the defined ones share them.
+        Returns for each program the (offset, line) pairs of its window, an
+        empty list if it is not defined or None if it was not probed."""
+        perLine = Pmac.smallListingIncrement // Pmac.listingProbeIncrement
+        commands = [
+            f"{pre_thing}list {thing},0,{Pmac.listingProbeIncrement}"
+            for thing, pre_thing in listings
+        ]
+        result = []
+        while len(result) < len(commands):
+            i = len(result)
+            batch = [commands[i]]
+            length = len(commands[i])
+            while (
+                i + len(batch) < len(commands)
+                and len(batch) < perLine
+                and length + 1 + len(commands[i + len(batch)]) <= self.maxCommandLength
+            ):
+                length += 1 + len(commands[i + len(batch)])
+                batch.append(commands[i + len(batch)])
+            (returnStr, status) = yield " ".join(batch)
+            answers = None
+            if status and "WARNING: response truncated" not in returnStr:
+                answers = self.splitListings(returnStr)
+            if answers is None or len(answers) > len(batch):
+                # Leave the rest to be listed one at a time
+                log.debug(f"Could not split listings: {returnStr!r}")
+                return result + [None] * (len(commands) - len(result))
+            result += answers
+        return result
+
+    def splitListings(self, returnStr):
+        """Splits the reply to a line of list commands that each list from the
+        start of a program into the (offset, line) pairs of each listing.  An
+        error ends the reply and stands for an undefined program.  Returns
+        None if the reply cannot be split."""
+        answers = []
+        pieces = returnStr.split("\r")
+        for index, piece in enumerate(pieces):
+            if piece.startswith("\x07"):
+                if index + 2 != len(pieces) or pieces[-1] != "":
+                    return None
+                answers.append([])
+                return answers
+            if piece == "\x06" and index + 1 == len(pieces):
+                return answers
+            match = re.fullmatch(r"(\d+):(.*)", piece, re.DOTALL)
+            if match is None:
+                return None
+            offset = match.group(1)
+            if offset == "0":
+                answers.append([])
+            elif not answers or int(offset) <= int(answers[-1][-1][0]):
+                return None
+            answers[-1].append((offset, match.group(2)))
+        return None
+
+    def readListing(self, thing, pre_thing="", probe=None):
+        """Returns the tokens, lines and offsets of a program.  In an
+        incremental readout a program whose fingerprint matches the one
+        stored by the previous readout is taken from the stored listing
+        instead of being listed again.  The fingerprint only samples the
+        program, so a change that keeps its length, first and last lines
+        will not be seen.  A probe from probeListings supplies the start of
+        the listing."""
+        key = f"{pre_thing}list {thing}"
+        cached = self.cachedListings.get(key)
+        if cached is not None:
+            command = self.fingerprintCommand(thing, pre_thing, cached["offsets"])
+            (returnStr, status) = yield command
+            if status and returnStr == cached["fingerprint"]:
+                log.debug(f"Using the stored listing of {key}")
+                tokens = []
+                for text, fileName, line in cached["tokens"]:
+                    t = PmacToken()
+                    t.set(text, fileName, line)
+                    tokens.append(t)
+                self.listings[key] = cached
+                return (tokens, cached["lines"], cached["offsets"])
+        if probe is None:
+            (lines, offsets) = yield from self.getListingLines(thing, pre_thing)
+        elif len(probe) == 0:
+            (lines, offsets) = ([], [])
+        else:
+            # The last line of the window may be incomplete, so list on from it
+            offsets = [offset for offset, _ in probe[:-1]]
+            lines = [line for _, line in probe[:-1]]
+            (more, moreOffsets) = yield from self.getListingLines(
+                thing, pre_thing, int(probe[-1][0])
+            )
+            lines += more
+            offsets += moreOffsets
+        tokens = PmacParser(lines, self).tokens()
+        if self.fingerprintFileName is not None and len(lines) > 0:
+            command = self.fingerprintCommand(thing, pre_thing, offsets)
+            (returnStr, status) = yield command
+            if status:
+                self.listings[key] = {
+                    "fingerprint": returnStr,
+                    "lines": lines,
+                    "offsets": offsets,
+                    "tokens": [[t.text, t.fileName, t.line] for t in tokens],
+                }
+        return (tokens, lines, offsets)
 
-    def getListingLines(self, thing, pre_thing=""):
-        """Returns the listing of a motion program or PLC using
-        small blocks.  It uses the start and length parameters
-        of the list command to slowly build up the listing.  Note
-        that the function fails if any chuck exceeds 1350 characters.
-        For use in small buffer mode."""
+    def getListingLines(self, thing, pre_thing="", startPos=0):
+        """Returns the listing of a motion program or PLC from the line at
+        startPos.  Large buffer mode is used when the connection supports
+        it, fetching most programs in a single window.  If a large listing
+        fails, the PMAC reverts to small buffer mode for the remainder of the
+        readout."""
+        if self.largeListings:
+            try:
+                return (
+                    yield from self.getListingLinesWindowed(
+                        thing, pre_thing, Pmac.largeListingIncrement, None, startPos
+                    )
+                )
+            except PmacReadError as e:
+                log.warning(
+                    f"Large buffer listing of {pre_thing}{thing} on {self.name} "
+                    f"failed ({e}), reverting to small buffer mode"
+                )
+                self.largeListings = False
+        return (
+            yield from self.getListingLinesWindowed(
+                thing,
+                pre_thing,
+                Pmac.smallListingIncrement,
+                Pmac.smallListingMaxLength,
+                startPos,
+            )
+        )
+
+    def getListingLinesWindowed(
+        self, thing, pre_thing, increment, maxLength, startPos=0
+    ):
+        """Returns the listing of a motion program or PLC from the line at
+        startPos using windows of increment words.  It uses the start and
+        length parameters of the list command to build up the listing.  The
+        function fails if any chunk exceeds maxLength characters or is
+        truncated."""
         lines = []
         offsets = []
-        startPos = 0
-        increment = 80
         going = True
         while going:
-            (returnStr, status) = self.sendCommand(
-                f"{pre_thing}list {thing},{startPos},{increment}"
-            )
+            (
+                returnStr,
+                status,
+            ) = yield f"{pre_thing}list {thing},{startPos},{increment}"
             startPos += increment
             if not status:
                 if returnStr.endswith("PMAC communication error"):
@@ -487,8 +1019,10 @@ class Pmac:
                     going = False
                 else:
                     raise PmacReadError(returnStr)
-            if len(returnStr) > 1350:
+            if maxLength is not None and len(returnStr) > maxLength:
                 raise PmacReadError("String too long for small buffer mode")
+            if "WARNING: response truncated" in returnStr:
+                raise PmacReadError("Listing response truncated")
             if returnStr.find("ERR") >= 0:
                 going = False
             else:
@@ -513,6 +1047,10 @@ class Pmac:
                 if len(more) < 4:
                     # get rid of ending \r\x06
                     lines[-1] = lines[-1][:-2]
+                    # No line is as long as a large window, so a single line
+                    # is the end of the program
+                    if maxLength is None:
+                        going = False
                 else:
                     startPos = int(offsets[-1])
                     # Chop off the last line (it may be incomplete) and adjust the start pos
@@ -525,27 +1063,29 @@ class Pmac:
         """Reads the PLC programs"""
         log.info("Reading PLC programs...")
         self.writeBackup("\n; PLC programs\n")
-        for plc in range(32):
-            (lines, offsets) = self.getListingLines(f"plc {plc}")
+        listings = yield from self.readListings(
+            [(f"plc {plc}", "") for plc in range(32)]
+        )
+        for plc, (tokens, lines, offsets) in enumerate(listings):
             if len(lines) > 0:
-                parser = PmacParser(lines, self)
-                var = PmacPlcProgram(plc, parser.tokens(), lines, offsets)
+                var = PmacPlcProgram(plc, tokens, lines, offsets)
                 self.hardwareState.addVar(var)
                 self.writeBackup(var.dump())
 
     def readMotionPrograms(self):
-        """Reads the motion programs. Note
-        that only the first 256 programs are read, there are actually 32768."""
+        """Reads the motion programs.  Note that by default only programs
+        1 to 255 are read, there are actually 32767.  Each program is listed,
+        as the PMAC has no query for which programs are defined."""
         log.info("Reading motion programs...")
         self.writeBackup("\n; Motion programs\n")
-        for prog in range(1, 256):
-            (lines, offsets) = self.getListingLines(f"program {prog}")
+        progs = range(1, self.maxProgram + 1)
+        listings = yield from self.readListings([(f"program {p}", "") for p in progs])
+        for prog, (tokens, lines, offsets) in zip(progs, listings, strict=True):
             if len(lines) == 1 and lines[0].find("ERR003") >= 0:
                 lines = []
                 offsets = []
             if len(lines) > 0:
-                parser = PmacParser(lines, self)
-                var = PmacMotionProgram(prog, parser.tokens(), lines, offsets)
+                var = PmacMotionProgram(prog, tokens, lines, offsets)
                 self.hardwareState.addVar(var)
                 self.writeBackup(var.dump())
 
@@ -556,7 +1096,7 @@ class Pmac:
             self.writeBackup("\n; Macro station I-variables\n")
             reqMacroStations = []
             if self.numMacroStationIcs >= 1:
-                (bits, status) = self.sendCommand("i6841")
+                (bits, status) = yield "i6841"
                 if status and bits[0] != "\x07":
                     bits = self.toNumber(bits[:-2])
                     for i in range(0, 14):
@@ -564,7 +1104,7 @@ class Pmac:
                             reqMacroStations += [i]
                         bits = bits >> 1
             if self.numMacroStationIcs >= 2:
-                (bits, status) = self.sendCommand("i6891")
+                (bits, status) = yield "i6891"
                 if status and bits[0] != "\x07":
                     bits = self.toNumber(bits[:-2])
                     for i in range(0, 14):
@@ -572,7 +1112,7 @@ class Pmac:
                             reqMacroStations += [i + 16]
                         bits = bits >> 1
             if self.numMacroStationIcs >= 3:
-                (bits, status) = self.sendCommand("i6941")
+                (bits, status) = yield "i6941"
                 if status and bits[0] != "\x07":
                     bits = self.toNumber(bits[:-2])
                     for i in range(0, 14):
@@ -580,7 +1120,7 @@ class Pmac:
                             reqMacroStations += [i + 32]
                         bits = bits >> 1
             if self.numMacroStationIcs >= 4:
-                (bits, status) = self.sendCommand("i6991")
+                (bits, status) = yield "i6991"
                 if status and bits[0] != "\x07":
                     bits = self.toNumber(bits[:-2])
                     for i in range(0, 14):
@@ -606,7 +1146,7 @@ class Pmac:
             ]
             roVars = [921, 922, 924, 930, 938, 939]
             for ms in reqMacroStations:
-                self.doMsIvars(ms, reqVars, roVars)
+                yield from self.timed(self.doMsIvars(ms, reqVars, roVars))
 
     def readGlobalMsIvars(self):
         """Reads the global macrostation I variables."""
@@ -648,7 +1188,7 @@ class Pmac:
             reqVars += [987, 988, 989, 992, 993, 994, 995, 996, 996, 998, 999]
             roVars = [4, 5, 12, 13, 209, 974]
             for ms in reqMacroStations:
-                self.doMsIvars(ms, reqVars, roVars)
+                yield from self.timed(self.doMsIvars(ms, reqVars, roVars))
             reqVars = list(range(16, 100))
             reqVars += range(101, 109)
             reqVars += range(111, 119)
@@ -676,39 +1216,66 @@ class Pmac:
             roVars = [4, 5, 12, 13, 209, 974]
             reqMacroStations = [16, 48]
             for ms in reqMacroStations:
-                self.doMsIvars(ms, reqVars, roVars)
+                yield from self.timed(self.doMsIvars(ms, reqVars, roVars))
 
     def doMsIvars(self, ms, reqVars, roVars):
         """Reads the specified set of global macrostation I variables."""
-        for v in reqVars:
-            (returnStr, status) = self.sendCommand(f"ms{ms},i{v}")
-            if status and returnStr[0] != "\x07":
-                var = PmacMsIVariable(ms, v, self.toNumber(returnStr[:-2]))
-                self.hardwareState.addVar(var)
-                self.writeBackup(var.dump())
-        for v in roVars:
-            (returnStr, status) = self.sendCommand(f"ms{ms},i{v}")
+        msVars = [(v, False) for v in reqVars] + [(v, True) for v in roVars]
+        replies = yield from self.queryBatch([f"ms{ms},i{v}" for v, _ in msVars])
+        for (v, ro), (returnStr, status) in zip(msVars, replies, strict=True):
             if status and returnStr[0] != "\x07":
-                var = PmacMsIVariable(ms, v, self.toNumber(returnStr[:-2]), ro=True)
+                var = PmacMsIVariable(ms, v, self.toNumber(returnStr[:-2]), ro=ro)
                 self.hardwareState.addVar(var)
                 self.writeBackup(var.dump())
 
-    def loadReference(self, factorySettings, includePaths=None):
-        """Loads the reference PMC file after first initialising the state."""
-        # Feedrate overrides default to 100
-        for cs in range(1, self.numCoordSystems + 1):
-            var = PmacFeedrateOverride(cs, 100.0)
-            self.referenceState.addVar(var)
+    def loadReference(self, factorySettings, includePaths=None, cacheDir=None):
+        """Loads the reference PMC file after first initialising the state.  If
+        a cacheDir is given the preprocessed reference is cached there."""
+        self.addDefaultFeedrateOverrides()
         if factorySettings is not None:
-            self.referenceState.copyFrom(factorySettings)
+            self.referenceState.setBase(factorySettings)
         if self.reference is not None:
             self.referenceState.setInlineExpressionResolutionState(self.hardwareState)
-            self.referenceState.loadPmcFileWithPreprocess(self.reference, includePaths)
+            self.referenceState.loadPmcFileWithPreprocess(
+                self.reference, includePaths, cacheDir
+            )
+
+    def addDefaultFeedrateOverrides(self):
+        """Feedrate overrides default to 100 in the reference."""
+        for cs in range(1, self.numCoordSystems + 1):
+            if self.referenceState.getFeedrateOverrideNoCreate(cs) is None:
+                var = PmacFeedrateOverride(cs, 100.0)
+                self.referenceState.addVar(var)
 
     def loadCompareWith(self):
         """Loads the compare with file."""
         self.hardwareState.loadPmcFile(self.compareWith)
 
+    def loadFiles(self, factorySettings, includePaths=None, cacheDir=None):
+        """Loads the compare with file, if there is one, and the reference.
+        Returns the variables this adds to the hardware state, which loading
+        the reference can do when it resolves inline expressions."""
+        hardwareAddrs = set(self.hardwareState.vars.keys())
+        if self.compareWith is not None:
+            self.loadCompareWith()
+        self.loadReference(factorySettings, includePaths, cacheDir)
+        result = PmacVariables()
+        for k, v in self.hardwareState.vars.items():
+            if k not in hardwareAddrs:
+                result[k] = v
+        return result
+
+    def setLoadedFiles(self, hardwareVars, referenceVars, factorySettings):
+        """Takes the variables loaded by loadFiles in another process: those
+        added to the hardware state and those of the reference state, which
+        is layered over the factory settings.  The files may have been loaded
+        before the number of coordinate systems was read, so any missing
+        default feedrate overrides are added."""
+        self.hardwareState.vars.update(hardwareVars)
+        self.referenceState.vars = referenceVars
+        self.referenceState.base = factorySettings
+        self.addDefaultFeedrateOverrides()
+
     def toNumber(self, text):
         if text[0] == "$":
             result = int(text[1:], 16)
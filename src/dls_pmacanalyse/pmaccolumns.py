@@ -0,0 +1,493 @@
+from array import array
+from collections.abc import MutableMapping
+
+from dls_pmacanalyse.pmacvariables import (
+    PmacIVariable,
+    PmacMsIVariable,
+    PmacMVariable,
+    PmacPVariable,
+    PmacQVariable,
+    PmacToken,
+)
+
+# The kinds of value held in a column.  An undefined entry has no variable.
+KIND_UNDEFINED = 0
+KIND_INT = 1
+KIND_FLOAT = 2
+KIND_OBJECT = 3
+
+# Integers of at most this magnitude are held exactly by a double
+MAX_EXACT_INT = 2**53
+
+# The number of entries of two columns compared at once
+COMPARE_BLOCK = 64
+
+
+class VariableColumn:
+    """Holds the values of a dense family of variables, such as the I
+    variables or the Q variables of one coordinate system, in arrays indexed
+    by variable number: a double per value, a byte giving the kind of value
+    (which is undefined for a number with no variable) and a read only flag.
+    A value that a double cannot hold exactly, such as a string, is kept in
+    a dictionary instead.  The arrays grow as variables are defined."""
+
+    size = 8192
+    # The value of a newly defined variable where it is not zero
+    defaultValues = {"ms": ""}
+
+    def __init__(self, family, node):
+        self.family = family
+        self.node = node
+        self.kinds = bytearray()
+        self.values = array("d")
+        self.ro = bytearray()
+        self.objects = {}
+
+    def grow(self, n):
+        length = min(max(n + 1, 2 * len(self.kinds), 64), self.size)
+        extra = length - len(self.kinds)
+        self.kinds.extend(bytes(extra))
+        self.values.frombytes(bytes(8 * extra))
+        self.ro.extend(bytes(extra))
+
+    def isDefined(self, n):
+        return n < len(self.kinds) and self.kinds[n] != KIND_UNDEFINED
+
+    def indices(self):
+        """Returns the numbers of the defined variables in order."""
+        kinds = self.kinds
+        return [n for n in range(len(kinds)) if kinds[n]]
+
+    def define(self, n):
+        """Defines the variable n with the default value."""
+        if n >= len(self.kinds):
+            self.grow(n)
+        self.objects.pop(n, None)
+        self.kinds[n] = KIND_INT
+        self.values[n] = 0
+        self.ro[n] = 0
+        default = self.defaultValues.get(self.family)
+        if default is not None:
+            self.setValue(n, default)
+
+    def undefine(self, n):
+        if self.isDefined(n):
+            self.objects.pop(n, None)
+            self.kinds[n] = KIND_UNDEFINED
+            self.values[n] = 0
+            self.ro[n] = 0
+
+    def getValue(self, n):
+        kind = self.kinds[n]
+        if kind == KIND_FLOAT:
+            return self.values[n]
+        elif kind == KIND_INT:
+            return int(self.values[n])
+        return self.objects[n]
+
+    def setValue(self, n, v):
+        if self.kinds[n] == KIND_OBJECT:
+            del self.objects[n]
+        if v.__class__ is float:
+            self.kinds[n] = KIND_FLOAT
+            self.values[n] = v
+        elif v.__class__ is int and -MAX_EXACT_INT <= v <= MAX_EXACT_INT:
+            self.kinds[n] = KIND_INT
+            self.values[n] = v
+        else:
+            self.kinds[n] = KIND_OBJECT
+            self.values[n] = 0
+            self.objects[n] = v
+
+    def getRo(self, n):
+        return self.ro[n] != 0
+
+    def setRo(self, n, ro):
+        self.ro[n] = 1 if ro else 0
+
+    def store(self, n, var):
+        """Defines the variable n as a copy of a variable."""
+        if n >= len(self.kinds):
+            self.grow(n)
+        if self.kinds[n] == KIND_UNDEFINED:
+            self.kinds[n] = KIND_INT
+        self.setValue(n, var.v)
+        self.setRo(n, var.ro)
+
+    def view(self, n):
+        return columnViews[self.family](self, n)
+
+    def copy(self):
+        result = self.__class__(self.family, self.node)
+        result.kinds = bytearray(self.kinds)
+        result.values = array("d", self.values)
+        result.ro = bytearray(self.ro)
+        result.objects = dict(self.objects)
+        return result
+
+
+class MVariableColumn(VariableColumn):
+    """A column of M variables, which also holds the definition of each.
+    The type and format strings, which may be given as tokens, are held as
+    codes into a table of the strings seen by the column."""
+
+    def __init__(self, family, node):
+        VariableColumn.__init__(self, family, node)
+        self.types = bytearray()
+        self.addresses = array("q")
+        self.offsets = array("H")
+        self.widths = array("H")
+        self.formats = bytearray()
+        self.strings = ["*", "U"]
+        self.codes = {"*": 0, "U": 1}
+        # Definitions that the arrays cannot hold
+        self.definitions = {}
+
+    def grow(self, n):
+        old = len(self.kinds)
+        VariableColumn.grow(self, n)
+        extra = len(self.kinds) - old
+        self.types.extend(bytes(extra))
+        self.addresses.frombytes(bytes(8 * extra))
+        self.offsets.frombytes(bytes(2 * extra))
+        self.widths.frombytes(bytes(2 * extra))
+        self.formats.extend(b"\x01" * extra)
+
+    def define(self, n):
+        VariableColumn.define(self, n)
+        self.setDefinition(n, "*", 0, 0, 0, "U")
+
+    def undefine(self, n):
+        if self.isDefined(n):
+            self.setDefinition(n, "*", 0, 0, 0, "U")
+        VariableColumn.undefine(self, n)
+
+    def code(self, text):
+        if text.__class__ is PmacToken:
+            text = text.text
+        result = self.codes.get(text)
+        if result is None and len(self.strings) < 256 and text.__class__ is str:
+            result = len(self.strings)
+            self.strings.append(text)
+            self.codes[text] = result
+        return result
+
+    def getDefinition(self, n):
+        """Returns the type, address, offset, width and format of M
+        variable n."""
+        definition = self.definitions.get(n)
+        if definition is not None:
+            return definition
+        return (
+            self.strings[self.types[n]],
+            self.addresses[n],
+            self.offsets[n],
+            self.widths[n],
+            self.strings[self.formats[n]],
+        )
+
+    def setDefinition(self, n, type, address, offset, width, format):
+        typeCode = self.code(type)
+        formatCode = self.code(format)
+        if (
+            typeCode is not None
+            and formatCode is not None
+            and address.__class__ is int
+            and -(2**63) <= address < 2**63
+            and offset.__class__ is int
+            and 0 <= offset < 65536
+            and width.__class__ is int
+            and 0 <= width < 65536
+        ):
+            self.definitions.pop(n, None)
+            self.types[n] = typeCode
+            self.addresses[n] = address
+            self.offsets[n] = offset
+            self.widths[n] = width
+            self.formats[n] = formatCode
+        else:
+            self.definitions[n] = (type, address, offset, width, format)
+
+    def setField(self, n, field, v):
+        definition = list(self.getDefinition(n))
+        definition[field] = v
+        self.setDefinition(n, *definition)
+
+    def copy(self):
+        result = VariableColumn.copy(self)
+        result.types = bytearray(self.types)
+        result.addresses = array("q", self.addresses)
+        result.offsets = array("H", self.offsets)
+        result.widths = array("H", self.widths)
+        result.formats = bytearray(self.formats)
+        result.strings = list(self.strings)
+        result.codes = dict(self.codes)
+        result.definitions = dict(self.definitions)
+        return result
+
+    def store(self, n, var):
+        VariableColumn.store(self, n, var)
+        self.setDefinition(n, var.type, var.address, var.offset, var.width, var.format)
+
+
+class ColumnView:
+    """The parts of a variable held in a column rather than by the variable
+    itself.  A view is made each time a variable is fetched, so fetching a
+    variable twice gives two views of the same entry."""
+
+    __slots__ = ()
+
+    v = property(
+        lambda self: self.column.getValue(self.n),
+        lambda self, v: self.column.setValue(self.n, v),
+    )
+    ro = property(
+        lambda self: self.column.getRo(self.n),
+        lambda self, ro: self.column.setRo(self.n, ro),
+    )
+
+
+class PmacIVariableView(ColumnView, PmacIVariable):
+    __slots__ = ("column",)
+
+    def __init__(self, column, n):
+        self.column = column
+        self.n = n
+
+
+class PmacPVariableView(ColumnView, PmacPVariable):
+    __slots__ = ("column",)
+
+    def __init__(self, column, n):
+        self.column = column
+        self.n = n
+
+
+class PmacQVariableView(ColumnView, PmacQVariable):
+    __slots__ = ("column",)
+
+    def __init__(self, column, n):
+        self.column = column
+        self.n = n
+        self.cs = column.node
+
+
+def definitionField(field):
+    return property(
+        lambda self: self.column.getDefinition(self.n)[field],
+        lambda self, v: self.column.setField(self.n, field, v),
+    )
+
+
+class PmacMsIVariableView(ColumnView, PmacMsIVariable):
+    __slots__ = ("column",)
+
+    def __init__(self, column, n):
+        self.column = column
+        self.n = n
+        self.ms = column.node
+
+
+class PmacMVariableView(ColumnView, PmacMVariable):
+    __slots__ = ("column",)
+
+    def __init__(self, column, n):
+        self.column = column
+        self.n = n
+
+    type = definitionField(0)
+    address = definitionField(1)
+    offset = definitionField(2)
+    width = definitionField(3)
+    format = definitionField(4)
+
+    def set(self, type, address, offset, width, format):
+        self.column.setDefinition(self.n, type, address, offset, width, format)
+
+
+columnViews = {
+    "i": PmacIVariableView,
+    "p": PmacPVariableView,
+    "m": PmacMVariableView,
+    "q": PmacQVariableView,
+    "ms": PmacMsIVariableView,
+}
+
+
+def mismatchedDefinitions(a, b, noCompare=None):
+    """Returns the numbers of the M variables of two columns, either of which
+    may be None, whose definitions may not compare equal.  As for
+    mismatchedIndices, read only variables and those set in the noCompare
+    mask are passed over."""
+    empty = VariableColumn("", 0)
+    a = empty if a is None else a
+    b = empty if b is None else b
+    length = max(len(a.kinds), len(b.kinds))
+    noCompare = bytearray(length) if noCompare is None else noCompare
+    result = []
+    for n in range(length):
+        aDefined = a.isDefined(n)
+        bDefined = b.isDefined(n)
+        if not aDefined and not bDefined or noCompare[n]:
+            continue
+        if (
+            aDefined
+            and bDefined
+            and (a.ro[n] or b.ro[n] or a.getDefinition(n) == b.getDefinition(n))
+        ):
+            continue
+        result.append(n)
+    return result
+
+
+def mismatchedIndices(a, b, noCompare=None):
+    """Returns the numbers of the variables of two columns, either of which
+    may be None, that may not compare equal.  The columns are compared a
+    block at a time, and a block whose kinds and values are the same in both
+    is passed over without looking at its entries.  An entry is then passed
+    over if it is numeric in both and either the values are equal or one is
+    read only, or if it is set in the noCompare mask, a bytearray at least
+    as long as the columns; a block whose mask is all set is passed over
+    too.  The entries that remain must be compared as variables, which
+    applies the tolerance for floating point values."""
+    empty = VariableColumn("", 0)
+    a = empty if a is None else a
+    b = empty if b is None else b
+    aKinds, bKinds = a.kinds, b.kinds
+    aValues, bValues = a.values, b.values
+    length = max(len(aKinds), len(bKinds))
+    noCompare = bytearray(length) if noCompare is None else noCompare
+    result = []
+    for start in range(0, length, COMPARE_BLOCK):
+        end = start + COMPARE_BLOCK
+        kinds = aKinds[start:end]
+        if (
+            kinds == bKinds[start:end]
+            and aValues[start:end] == bValues[start:end]
+            and KIND_OBJECT not in kinds
+        ) or 0 not in noCompare[start:end]:
+            continue
+        for n in range(start, min(end, length)):
+            aDefined = a.isDefined(n)
+            bDefined = b.isDefined(n)
+            if not aDefined and not bDefined or noCompare[n]:
+                continue
+            if (
+                aDefined
+                and bDefined
+                and aKinds[n] != KIND_OBJECT
+                and bKinds[n] != KIND_OBJECT
+                and (a.ro[n] or b.ro[n] or aValues[n] == bValues[n])
+            ):
+                continue
+            result.append(n)
+    return result
+
+
+class PmacVariables(MutableMapping):
+    """The variables of a PMAC state, keyed on a tuple of their family, their
+    coordinate system or macro station node (0 for a global variable) and
+    their number.  The I, P, M, Q and MS I variables are held in columns,
+    one for each family and node, and fetching one of them returns a view of
+    its column.  Everything else, and any variable numbered outside the
+    range of a column, is held in a dictionary."""
+
+    columnFamilies = ("i", "p", "m", "q", "ms")
+
+    def __init__(self):
+        self.columns = {}
+        self.others = {}
+
+    @staticmethod
+    def inColumn(n):
+        return n.__class__ is int and 0 <= n < VariableColumn.size
+
+    @classmethod
+    def isColumnKey(cls, key):
+        family, node, n = key
+        return family in cls.columnFamilies and cls.inColumn(node) and cls.inColumn(n)
+
+    def column(self, family, node):
+        """Returns the column of a family and node, creating it if need be."""
+        key = (family, node)
+        result = self.columns.get(key)
+        if result is None:
+            if family == "m":
+                result = MVariableColumn(family, node)
+            else:
+                result = VariableColumn(family, node)
+            self.columns[key] = result
+        return result
+
+    def definedColumn(self, family, node, n):
+        """Returns the column of a family and node if variable n is defined
+        in it, otherwise None."""
+        result = self.columns.get((family, node))
+        if result is not None and result.isDefined(n):
+            return result
+        return None
+
+    def get(self, key, default=None):
+        if not self.isColumnKey(key):
+            return self.others.get(key, default)
+        column = self.definedColumn(*key)
+        if column is None:
+            return default
+        return column.view(key[2])
+
+    def __getitem__(self, key):
+        result = self.get(key)
+        if result is None:
+            raise KeyError(key)
+        return result
+
+    def __contains__(self, key):
+        if not self.isColumnKey(key):
+            return key in self.others
+        return self.definedColumn(*key) is not None
+
+    def __setitem__(self, key, var):
+        """Stores a variable.  A variable held in a column is copied, so
+        changing it after storing it does not change this state."""
+        if self.isColumnKey(key):
+            family, node, n = key
+            self.column(family, node).store(n, var)
+        else:
+            self.others[key] = var
+
+    def __delitem__(self, key):
+        if not self.isColumnKey(key):
+            del self.others[key]
+        else:
+            column = self.definedColumn(*key)
+            if column is None:
+                raise KeyError(key)
+            column.undefine(key[2])
+
+    def __iter__(self):
+        for (family, node), column in list(self.columns.items()):
+            for n in column.indices():
+                yield (family, node, n)
+        yield from list(self.others)
+
+    def __len__(self):
+        result = len(self.others)
+        for column in self.columns.values():
+            result += len(column.kinds) - column.kinds.count(KIND_UNDEFINED)
+        return result
+
+    def add(self, var):
+        """Stores a variable at its key."""
+        self[var.key()] = var
+
+    def addCopy(self, key, var):
+        """Stores a copy of a variable, returning the stored variable."""
+        if self.isColumnKey(key):
+            family, node, n = key
+            column = self.column(family, node)
+            column.store(n, var)
+            result = column.view(n)
+        else:
+            result = var.copyFrom()
+            self.others[key] = result
+        return result
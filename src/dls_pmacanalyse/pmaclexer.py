@@ -1,3 +1,5 @@
+import re
+
 from dls_pmacanalyse.errors import LexerError, ParserError
 from dls_pmacanalyse.pmacvariables import PmacToken
 
@@ -297,16 +299,38 @@ class PmacLexer:
         "MI": "I",
     }
     tokenPairs = {"END WHILE": "ENDWHILE", "END IF": "ENDIF", "END GATHER": "ENDGATHER"}
+    # A single expression that matches the longest token at the start of a
+    # line: a (possibly real) number, a hexadecimal number (which also
+    # catches the single $ token), a literal string, or the longest of the
+    # normal and short form tokens.  Alternatives are tried in order, so the
+    # tokens are ordered longest first.
+    tokenRegExp = re.compile(
+        r'[0-9]+(?:\.[0-9]+)?|\$[0-9A-F]*|"[^"]*"|'
+        + "|".join(
+            re.escape(t)
+            for t in sorted(set(tokens) | set(shortTokens), key=lambda t: (-len(t), t))
+        )
+    )
 
     def __init__(self, source, debug=False):
-        self.tokens = []
         self.curToken = ""
         self.matchToken = None
         self.line = 0
         self.fileName = ""
         self.debug = debug
+        # Tokens are produced lazily from the source as the parser asks for
+        # them, so that a large file is never held as tokens all at once.
+        # Tokens put back by the parser are stacked in front of the stream.
+        self.stream = self.generateTokens(source)
+        self.putBack = []
+
+    def generateTokens(self, source):
+        """Generates the tokens of the source lines.  The last token is held
+        back until the next one is known, as the two may form a token pair
+        that is replaced by a single token."""
         hasDebugInfo = False
         lastToken = None
+        pending = None
         # Process every line...
         for line in source:
             if not hasDebugInfo:
@@ -328,85 +352,34 @@ class PmacLexer:
                     if lastToken is not None:
                         pair = f"{lastToken} {t}"
                         if pair in self.tokenPairs:
-                            self.tokens[-1].set(
-                                self.tokenPairs[pair], self.fileName, self.line
-                            )
+                            pending.set(self.tokenPairs[pair], self.fileName, self.line)
                             lastToken = None
                         else:
-                            self.tokens.append(t)
+                            if pending is not None:
+                                yield pending
+                            pending = t
                             lastToken = t
                     else:
-                        self.tokens.append(t)
+                        if pending is not None:
+                            yield pending
+                        pending = t
                         lastToken = t
                     line = line[len(token) :].lstrip()
                 t = PmacToken()
                 t.set("\n", self.fileName, self.line)
-                self.tokens.append(t)
+                if pending is not None:
+                    yield pending
+                pending = t
+        if pending is not None:
+            yield pending
 
     def findToken(self, text):
         """Find the longest token at the start of the text."""
-        bestToken = ""
-        # Try for a (possibly real) number
-        if text[0].isdigit():
-            isNumber = True
-            hasDot = False
-            pos = 0
-            curToken = ""
-            while pos < len(text) and isNumber:
-                ch = text[pos]
-                if ch.isdigit():
-                    curToken += ch
-                elif not hasDot and ch == ".":
-                    hasDot = True
-                    curToken += ch
-                else:
-                    isNumber = False
-                pos += 1
-            if len(curToken) > 0 and curToken[-1] == ".":
-                # Float cannot have a trailing dot
-                curToken = curToken[:-1]
-            bestToken = curToken
-        # Try for a hexadecimal number (also catches the single $ token)
-        elif text[0] == "$":
-            pos = 1
-            curToken = "$"
-            isNumber = True
-            while pos < len(text) and isNumber:
-                ch = text[pos]
-                if ch in "0123456789ABCDEF":
-                    curToken += ch
-                else:
-                    isNumber = False
-                pos += 1
-            bestToken = curToken
-        # Try for a literal string
-        elif text[0] == '"':
-            curToken = '"'
-            pos = 1
-            noTerminator = True
-            while pos < len(text) and noTerminator:
-                ch = text[pos]
-                curToken += ch
-                if ch == '"':
-                    noTerminator = False
-                pos += 1
-            if noTerminator:
-                raise LexerError(text, self.fileName, self.line)
-            else:
-                bestToken = curToken
-        else:
-            # Try the tokens in the normal list
-            for t in PmacLexer.tokens:
-                if len(t) > len(bestToken) and text.startswith(t):
-                    bestToken = t
-            # Try the tokens in the short dictionary
-            for t, _f in PmacLexer.shortTokens.items():
-                if len(t) > len(bestToken) and text.startswith(t):
-                    bestToken = t
-        if len(bestToken) == 0:
+        match = PmacLexer.tokenRegExp.match(text)
+        if match is None:
             raise LexerError(text, self.fileName, self.line)
-        # log.debug('{%s from %s}' % (bestToken, text))
-        return bestToken
+        # log.debug('{%s from %s}' % (match.group(), text))
+        return match.group()
 
     def expandToken(self, token):
         """If the token is a short form, it is expanded to the full form."""
@@ -415,22 +388,30 @@ class PmacLexer:
             result = PmacLexer.shortTokens[token]
         return result
 
+    def nextToken(self):
+        """Returns the next token, or None at the end of the source."""
+        if len(self.putBack) > 0:
+            return self.putBack.pop()
+        return next(self.stream, None)
+
     def getToken(self, shouldBe=None, wantEol=False):
-        """Returns the first token and removes it from the list."""
-        result = None
+        """Returns the first token and removes it from the stream."""
+        result = self.nextToken()
         # Skip any newline tokens unless they are wanted
-        while not wantEol and len(self.tokens) > 0 and self.tokens[0] == "\n":
-            self.line += 1
-            self.tokens[:1] = []
-        # Get the head token
-        if len(self.tokens) > 0:
-            result = self.tokens[0]
-            self.tokens[:1] = []
+        while not wantEol and result is not None and result == "\n":
+            result = self.nextToken()
         # Is it the expected one
         if shouldBe is not None and not shouldBe == result:
             raise ParserError(f"Expected {shouldBe}, got {result}", result)
         return result
 
     def putToken(self, token):
-        """Puts a token at the head of the list."""
-        self.tokens[:0] = [token]
+        """Puts a token at the head of the stream."""
+        self.putBack.append(token)
+
+    def remainingTokens(self):
+        """Returns a list of the tokens not yet consumed, without consuming
+        them."""
+        tokens = self.putBack[::-1] + list(self.stream)
+        self.putBack = tokens[::-1]
+        return tokens
@@ -13,7 +13,7 @@ class PmacParser:
         self.debug = debug
 
     def tokens(self):
-        return self.lexer.tokens
+        return self.lexer.remainingTokens()
 
     def onLine(self):
         """Top level on-line command mode parser."""
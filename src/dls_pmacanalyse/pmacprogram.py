@@ -15,8 +15,8 @@ log = getLogger(__name__)
 
 
 class PmacProgram(PmacVariable):
-    def __init__(self, prefix, n, v, lines=None, offsets=None):
-        PmacVariable.__init__(self, prefix, n, v)
+    def __init__(self, n, v, lines=None, offsets=None):
+        PmacVariable.__init__(self, n, v)
         self.offsets = offsets
         self.lines: list[str] = lines or []
 
@@ -29,61 +29,67 @@ class PmacProgram(PmacVariable):
         self.v = []
 
     def valueText(self, typ=0, ignore_ret=False):
-        result = ""
+        # The text is collected as a list of parts, tracking the last
+        # character and the length of the current line, rather than by
+        # repeatedly extending and searching a string
+        result = []
+        lastChar = ""
+        lineLen = 0
         last_line = len(self.v) - 1
         for i, t in enumerate(self.v):
             if t == "\n":
-                if len(result) > 0 and not result[-1] == "\n":
-                    result += str(t)
+                if lastChar != "" and lastChar != "\n":
+                    result.append("\n")
+                    lastChar = "\n"
+                    lineLen = 0
             elif not ignore_ret or t != "RETURN" or i < last_line:
-                if len(result) == 0:
+                text = str(t)
+                if lastChar == "":
                     pass
-                elif result[-1].isalpha() and str(t)[0].isalpha():
-                    result += " "
-                elif result[-1].isdigit() and str(t)[0].isdigit():
-                    result += " "
-                result += str(t)
-                if typ == 1 and len(result.rsplit("\n", 1)[-1]) > 60:
-                    result += "\n"
-        if len(result) == 0 or result[-1] != "\n":
-            result += "\n"
-        return result
+                elif lastChar.isalpha() and text[0].isalpha():
+                    result.append(" ")
+                    lineLen += 1
+                elif lastChar.isdigit() and text[0].isdigit():
+                    result.append(" ")
+                    lineLen += 1
+                result.append(text)
+                if len(text) > 0:
+                    lastChar = text[-1]
+                lineLen += len(text)
+                if typ == 1 and lineLen > 60:
+                    result.append("\n")
+                    lastChar = "\n"
+                    lineLen = 0
+        if lastChar != "\n":
+            result.append("\n")
+        return "".join(result)
 
     def compare(self, other):
-        # Strip the newline tokens from the two lists.  There's
-        # probably a better way of doing this.
-        a = []
-        for i in self.v:
-            if i == "\n":
-                pass
-            else:
-                a.append(i)
-        b = []
-        for i in other.v:
-            if i == "\n":
-                pass
-            else:
-                b.append(i)
+        # Strip the newline tokens from the two lists
+        a = [t for t in self.v if t != "\n"]
+        b = [t for t in other.v if t != "\n"]
         # Now compare them token by token
         result = True
-        while len(a) > 0 and len(b) > 0:
+        i = 0
+        j = 0
+        while i < len(a) and j < len(b):
             # Extract the current head token from each list
-            a0 = a[0]
-            b0 = b[0]
-            a[0:1] = []
-            b[0:1] = []
+            a0 = a[i]
+            b0 = b[j]
+            i += 1
+            j += 1
             # Compare them
             if isNumber(a0) and isNumber(b0):
                 if not compareFloats(toNumber(a0), toNumber(b0), 0.00001):
                     result = False
                     a0.compareFail = True
                     b0.compareFail = True
-            elif a0 == "COMMAND" and b0 == "COMMAND" and len(a) > 0 and len(b) > 0:
+            elif a0 == "COMMAND" and b0 == "COMMAND" and i < len(a) and j < len(b):
                 # Get the command strings
-                a0 = a[0]
-                b0 = b[0]
-                a[0:1] = []
-                b[0:1] = []
+                a0 = a[i]
+                b0 = b[j]
+                i += 1
+                j += 1
                 if isString(str(a0)) and isString(str(b0)):
                     # Parse them
                     parserA = PmacParser([stripStringQuotes(str(a0))], self)
@@ -104,10 +110,10 @@ class PmacProgram(PmacVariable):
                     result = False
                     a0.compareFail = True
                     b0.compareFail = True
-        for a0 in a:
+        for a0 in a[i:]:
             a0.compareFail = True
             result = False
-        for b0 in b:
+        for b0 in b[j:]:
             b0.compareFail = True
             result = False
         return result
@@ -152,10 +158,12 @@ class PmacProgram(PmacVariable):
 
 
 class PmacPlcProgram(PmacProgram):
+    family = "plc"
+
     def __init__(self, n, v=None, lines=None, offsets=None):
         if v is None:
             v = []
-        PmacProgram.__init__(self, "plc", n, v, lines, offsets)
+        PmacProgram.__init__(self, n, v, lines, offsets)
         self.isRunning = False
         self.shouldBeRunning = False
 
@@ -204,17 +212,24 @@ class PmacPlcProgram(PmacProgram):
 
 
 class PmacCommandString(PmacProgram):
+    family = "CMD"
+
     def __init__(self, v):
-        PmacProgram.__init__(self, "CMD", 0, v)
+        PmacProgram.__init__(self, 0, v)
 
 
 class PmacCsAxisDef(PmacProgram):
+    family = "#"
+
     def __init__(self, cs, n, v=None):
         if v is None:
             v = [PmacToken("0")]
-        PmacProgram.__init__(self, f"&{cs}#", n, v)
+        PmacProgram.__init__(self, n, v)
         self.cs = cs
 
+    def key(self):
+        return (self.family, self.cs, self.n)
+
     def dump(self, typ=0):
         if typ == 1:
             result = f"{self.valueText()}"
@@ -241,10 +256,12 @@ class PmacCsAxisDef(PmacProgram):
 
 
 class PmacForwardKinematicProgram(PmacProgram):
+    family = "fwd"
+
     def __init__(self, n, v=None):
         if v is None:
             v = []
-        PmacProgram.__init__(self, "fwd", n, v)
+        PmacProgram.__init__(self, n, v)
 
     def dump(self, typ=0):
         if typ == 1:
@@ -267,10 +284,12 @@ class PmacForwardKinematicProgram(PmacProgram):
 
 
 class PmacInverseKinematicProgram(PmacProgram):
+    family = "inv"
+
     def __init__(self, n, v=None):
         if v is None:
             v = []
-        PmacProgram.__init__(self, "inv", n, v)
+        PmacProgram.__init__(self, n, v)
 
     def dump(self, typ=0):
         if typ == 1:
@@ -293,10 +312,12 @@ class PmacInverseKinematicProgram(PmacProgram):
 
 
 class PmacMotionProgram(PmacProgram):
+    family = "prog"
+
     def __init__(self, n, v=None, lines=None, offsets=None):
         if v is None:
             v = []
-        PmacProgram.__init__(self, "prog", n, v, lines, offsets)
+        PmacProgram.__init__(self, n, v, lines, offsets)
 
     def dump(self, typ=0):
         if typ == 1:
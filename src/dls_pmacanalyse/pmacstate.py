@@ -1,9 +1,12 @@
-from functools import cmp_to_key
+from collections import ChainMap
 from logging import getLogger
 from typing import Union, cast
 
-from dls_pmaclib.dls_pmcpreprocessor import ClsPmacParser
-
+from dls_pmacanalyse.pmaccolumns import (
+    PmacVariables,
+    mismatchedDefinitions,
+    mismatchedIndices,
+)
 from dls_pmacanalyse.pmacparser import PmacParser
 from dls_pmacanalyse.pmacprogram import (
     PmacCsAxisDef,
@@ -20,10 +23,12 @@ from dls_pmacanalyse.pmacvariables import (
     PmacPVariable,
     PmacQVariable,
     PmacVariable,
+    keyAddress,
+    keyOrder,
 )
+from dls_pmacanalyse.pmccache import PreprocessorCache, preprocess
 
-from .errors import AnalyseError, GeneralError
-from .utils import numericSort
+from .errors import AnalyseError, GeneralError, UnresolvedExpressionError
 
 log = getLogger(__name__)
 
@@ -587,20 +592,10 @@ class PmacState:
     }
 
     def __init__(self, descr):
-        self.vars: dict[
-            str,
-            PmacMotionProgram
-            | PmacPlcProgram
-            | PmacForwardKinematicProgram
-            | PmacInverseKinematicProgram
-            | PmacPVariable
-            | PmacIVariable
-            | PmacMVariable
-            | PmacQVariable
-            | PmacMsIVariable
-            | PmacCsAxisDef
-            | PmacFeedrateOverride,
-        ] = {}
+        self.vars = PmacVariables()
+        # A state may be layered over a shared base state, in which case
+        # vars only holds the variables that differ from the base
+        self.base: PmacState | None = None
         self.descr = descr
         self.inlineExpressionResolutionState = None
 
@@ -620,71 +615,167 @@ class PmacState:
         return self.inlineExpressionResolutionState.getMVariable(n).getFloatValue()
 
     def addVar(self, var):
-        self.vars[var.addr()] = var
+        self.vars.add(var)
 
     def removeVar(self, var):
-        if var.addr() in self.vars:
-            del self.vars[var.addr()]
+        if var.key() in self.vars:
+            del self.vars[var.key()]
 
     def copyFrom(self, other):
         for k, v in other.vars.items():
-            self.vars[k] = v.copyFrom()
+            self.vars.addCopy(k, v)
+
+    def setBase(self, base):
+        """Layers this state over a base state.  This has the effect of
+        copying every variable of the base into this state, but the base
+        variables are shared rather than copied.  A base variable is copied
+        into this state when it is first fetched by one of the get functions
+        that create variables, as the caller may change it.  The base state
+        must not change while it is in use as a base."""
+        for k in list(self.vars.keys()):
+            if base.lookupVar(k) is not None:
+                del self.vars[k]
+        self.base = base
+
+    def lookupVar(self, key):
+        """Returns the variable with a key, which may belong to the base state
+        and so must not be changed, or None."""
+        result = self.vars.get(key)
+        if result is None and self.base is not None:
+            result = self.base.lookupVar(key)
+        return result
+
+    def allVars(self):
+        """Returns a read only mapping of the keys to the variables of this
+        state, including those of the base state."""
+        if self.base is None:
+            return self.vars
+        return ChainMap(self.vars, self.base.allVars())
+
+    def inBase(self, key):
+        return self.base is not None and self.base.lookupVar(key) is not None
+
+    def copyFromBase(self, key):
+        """Copies the base variable with a key into this state, returning the
+        copy."""
+        return self.vars.addCopy(key, self.base.lookupVar(key))
+
+    def lookupColumn(self, family, node, n):
+        """Returns the column holding variable n of a family and node, which
+        may belong to the base state, or None if it is not defined."""
+        result = self.vars.definedColumn(family, node, n)
+        if result is None and self.base is not None:
+            result = self.base.lookupColumn(family, node, n)
+        return result
+
+    def compareColumn(self, family, node):
+        """Returns the column of a family and node seen through the layers of
+        this state, or None if no layer has one.  Where more than one layer
+        has entries the column is a merged copy, which must not be changed."""
+        result = self.vars.columns.get((family, node))
+        if self.base is not None:
+            below = self.base.compareColumn(family, node)
+            if below is not None:
+                indices = [] if result is None else result.indices()
+                if len(indices) > 0:
+                    merged = below.copy()
+                    for n in indices:
+                        merged.store(n, result.view(n))
+                    below = merged
+                result = below
+        return result
+
+    def columnKeys(self):
+        """Returns the families and nodes of the columns of every layer."""
+        result = set(self.vars.columns)
+        if self.base is not None:
+            result |= self.base.columnKeys()
+        return result
+
+    def otherKeys(self):
+        """Returns the keys of the variables of every layer that are not held
+        in columns."""
+        result = set(self.vars.others)
+        if self.base is not None:
+            result |= self.base.otherKeys()
+        return result
+
+    def getColumnVar(self, key):
+        """Returns a view of the variable with a key held in a column,
+        defining it if need be."""
+        family, node, n = key
+        column = self.vars.column(family, node)
+        if not column.isDefined(n):
+            baseColumn = None
+            if self.base is not None:
+                baseColumn = self.base.lookupColumn(family, node, n)
+            if baseColumn is not None:
+                column.store(n, baseColumn.view(n))
+            else:
+                column.define(n)
+        return column.view(n)
 
     def getVar(self, t: str, n: int) -> PmacVariable:
-        addr = f"{t}{n}"
-        if addr in self.vars:
-            result = self.vars[addr]
-        else:
-            if t == "prog":
-                result = PmacMotionProgram(n)
-            elif t == "plc":
-                result = PmacPlcProgram(n)
-            elif t == "fwd":
-                result = PmacForwardKinematicProgram(n)
-            elif t == "inv":
-                result = PmacInverseKinematicProgram(n)
-            elif t == "p":
-                result = PmacPVariable(n)
-            elif t == "i":
-                result = PmacIVariable(n)
-            elif t == "m":
-                result = PmacMVariable(n)
+        key = (t, 0, n)
+        if PmacVariables.isColumnKey(key):
+            return self.getColumnVar(key)
+        result = self.vars.get(key)
+        if result is None:
+            if self.inBase(key):
+                result = self.copyFromBase(key)
             else:
-                raise GeneralError(f"Illegal program type: {t}")
-            self.vars[addr] = result
+                if t == "prog":
+                    result = PmacMotionProgram(n)
+                elif t == "plc":
+                    result = PmacPlcProgram(n)
+                elif t == "fwd":
+                    result = PmacForwardKinematicProgram(n)
+                elif t == "inv":
+                    result = PmacInverseKinematicProgram(n)
+                elif t == "p":
+                    result = PmacPVariable(n)
+                elif t == "i":
+                    result = PmacIVariable(n)
+                elif t == "m":
+                    result = PmacMVariable(n)
+                else:
+                    raise GeneralError(f"Illegal program type: {t}")
+                self.vars[key] = result
         return result
 
+    @staticmethod
+    def varKey2(t1, n1, t2, n2):
+        """Returns the key of a variable of a coordinate system or macro
+        station node."""
+        return ("ms" if t1 == "ms" else t2, n1, n2)
+
     def getVar2(self, t1: str, n1: int, t2: str, n2: int) -> PmacVariable:
-        addr = f"{t1}{n1}{t2}{n2}"
-        if addr in self.vars:
-            result = self.vars[addr]
-        else:
-            if t2 == "q":
-                result = PmacQVariable(n1, n2)
-            elif t2 == "i":
-                result = PmacMsIVariable(n1, n2)
-            elif t2 == "#":
-                result = PmacCsAxisDef(n1, n2)
-            elif t2 == "%":
-                result = PmacFeedrateOverride(n1)
+        key = self.varKey2(t1, n1, t2, n2)
+        if PmacVariables.isColumnKey(key):
+            return self.getColumnVar(key)
+        result = self.vars.get(key)
+        if result is None:
+            if self.inBase(key):
+                result = self.copyFromBase(key)
             else:
-                raise GeneralError(f"Illegal program type: {t1}x{t2}")
-            self.vars[addr] = result
+                if t2 == "q":
+                    result = PmacQVariable(n1, n2)
+                elif t2 == "i":
+                    result = PmacMsIVariable(n1, n2)
+                elif t2 == "#":
+                    result = PmacCsAxisDef(n1, n2)
+                elif t2 == "%":
+                    result = PmacFeedrateOverride(n1)
+                else:
+                    raise GeneralError(f"Illegal program type: {t1}x{t2}")
+                self.vars[key] = result
         return result
 
     def getVarNoCreate(self, t: str, n: int) -> PmacVariableResult:
-        addr = f"{t}{n}"
-        result = None
-        if addr in self.vars:
-            result = self.vars[addr]
-        return result
+        return self.lookupVar((t, 0, n))
 
     def getVarNoCreate2(self, t1: str, n1: int, t2: str, n2: int) -> PmacVariableResult:
-        addr = f"{t1}{n1}{t2}{n2}"
-        result = None
-        if addr in self.vars:
-            result = self.vars[addr]
-        return result
+        return self.lookupVar(self.varKey2(t1, n1, t2, n2))
 
     def getMotionProgram(self, n):
         return cast(PmacMotionProgram, self.getVar("prog", n))
@@ -739,7 +830,7 @@ class PmacState:
 
     def dump(self):
         result = ""
-        for _a, v in self.vars.items():
+        for _a, v in self.allVars().items():
             result += v.dump()
         return result
 
@@ -812,20 +903,33 @@ class PmacState:
         """Compares the state of this PMAC with the other."""
         result = True
         table = page.table(page.body(), ["Element", "Reason", "Reference", "Hardware"])
-        # Build the list of variable addresses to test
-        addrs = sorted(
-            (set(self.vars.keys()) | set(other.vars.keys()))
-            - set(noCompare.vars.keys()),
-            key=cmp_to_key(numericSort),
-        )
-        # For each of these addresses, compare the variable
-        for a in addrs:
+        # Build the list of variables to test.  The I, P, M, Q and MS I
+        # variables are held in columns, of which only the entries that may
+        # differ need be tested.  For the M variables it is the definitions
+        # that are compared rather than the values.
+        # The variables not to compare are masked out of the columns.
+        keys = {
+            key for key in self.otherKeys() | other.otherKeys() if key not in noCompare
+        }
+        for family, node in self.columnKeys() | other.columnKeys():
+            mine = self.compareColumn(family, node)
+            theirs = other.compareColumn(family, node)
+            length = max(len(c.kinds) for c in (mine, theirs) if c is not None)
+            skip = noCompare.mask(family, node, length)
+            if family == "m":
+                indices = mismatchedDefinitions(mine, theirs, skip)
+            else:
+                indices = mismatchedIndices(mine, theirs, skip)
+            keys.update((family, node, n) for n in indices)
+        # For each of these variables, in address order, compare the variable
+        for key in sorted(keys, key=keyOrder):
+            family, _, i = key
+            a = keyAddress(key)
             texta = a
             commentargs = {}
-            if texta.endswith("%0"):
+            if family == "%":
                 texta = texta[:-1]
-            if texta.startswith("i") and not texta.startswith("inv"):
-                i = int(texta[1:])
+            if family == "i":
                 if i in range(100):
                     desc = PmacState.globalIVariableDescriptions[i]
                     commentargs["comment"] = desc
@@ -838,30 +942,28 @@ class PmacState:
                 else:
                     desc = "No description available"
                 texta = page.doc_node(a, desc)
-            if a not in other.vars:
-                if not self.vars[a].ro and not self.vars[a].isEmpty():
+            mine = self.lookupVar(key)
+            theirs = other.lookupVar(key)
+            if theirs is None:
+                if not mine.ro and not mine.isEmpty():
                     result = False
-                    self.writeHtmlRow(page, table, texta, "Missing", None, self.vars[a])
+                    self.writeHtmlRow(page, table, texta, "Missing", None, mine)
                     if unfixfile is not None:
-                        unfixfile.write(self.vars[a].dump(**commentargs))
-            elif a not in self.vars:
-                if not other.vars[a].ro and not other.vars[a].isEmpty():
+                        unfixfile.write(mine.dump(**commentargs))
+            elif mine is None:
+                if not theirs.ro and not theirs.isEmpty():
                     result = False
-                    self.writeHtmlRow(
-                        page, table, texta, "Missing", other.vars[a], None
-                    )
+                    self.writeHtmlRow(page, table, texta, "Missing", theirs, None)
                     if fixfile is not None:
-                        fixfile.write(other.vars[a].dump())
-            elif not self.vars[a].compare(other.vars[a]):
-                if not other.vars[a].ro and not self.vars[a].ro:
+                        fixfile.write(theirs.dump())
+            elif not mine.compare(theirs):
+                if not theirs.ro and not mine.ro:
                     result = False
-                    self.writeHtmlRow(
-                        page, table, texta, "Mismatch", other.vars[a], self.vars[a]
-                    )
+                    self.writeHtmlRow(page, table, texta, "Mismatch", theirs, mine)
                     if fixfile is not None:
-                        fixfile.write(other.vars[a].dump())
+                        fixfile.write(theirs.dump())
                     if unfixfile is not None:
-                        unfixfile.write(self.vars[a].dump(**commentargs))
+                        unfixfile.write(mine.dump(**commentargs))
         # Check the running PLCs
         for n in range(32):
             plc = self.getPlcProgramNoCreate(n)
@@ -917,17 +1019,30 @@ class PmacState:
         parser = PmacParser(file, self)
         parser.onLine()
 
-    def loadPmcFileWithPreprocess(self, fileName, includePaths):
+    def loadPmcFileWithPreprocess(self, fileName, includePaths, cacheDir=None):
         """
         Loads a PMC file into this PMAC state having expanded includes and defines.
+        If a cacheDir is given the preprocessed file is cached there.
         """
-        if includePaths is not None:
-            p = ClsPmacParser(includePaths=includePaths.split(":"))
-        else:
-            p = ClsPmacParser()
         log.info("Loading PMC file %s...", fileName)
-        converted = p.parse(fileName, debug=True)
+        if cacheDir is not None:
+            converted = PreprocessorCache(cacheDir).preprocess(fileName, includePaths)
+        else:
+            converted = preprocess(fileName, includePaths)
         if converted is None:
             raise AnalyseError(f"Could not open reference file: {fileName}")
-        parser = PmacParser(p.output, self)
+        parser = PmacParser(converted, self)
         parser.onLine()
+
+
+class UnreadPmacState(PmacState):
+    """Stands in for the hardware state of a PMAC that has not been read yet,
+    so that its reference can be loaded during the readout.  Resolving an
+    inline expression against it raises an UnresolvedExpressionError, as the
+    hardware value is not yet known."""
+
+    def getVar(self, t: str, n: int) -> PmacVariable:
+        raise UnresolvedExpressionError(f"Hardware not yet read: {t}{n}")
+
+    def getVar2(self, t1: str, n1: int, t2: str, n2: int) -> PmacVariable:
+        raise UnresolvedExpressionError(f"Hardware not yet read: {t1}{n1}{t2}{n2}")
@@ -1,19 +1,28 @@
+import sys
+
 from dls_pmacanalyse.errors import GeneralError
 from dls_pmacanalyse.utils import tokenIsFloat, tokenToFloat
 
 
 class PmacToken:
+    # Programs are held as lists of tokens, of which there can be hundreds
+    # of thousands, so tokens have no instance dictionary.  Token texts and
+    # file names are interned: the many tokens with the same text or from
+    # the same file share a single string, and comparing the texts of two
+    # tokens is usually an identity check.
+    __slots__ = ("text", "fileName", "line", "compareFail")
+
     def __init__(self, text=None):
         self.fileName = ""
         self.line = ""
         self.text = ""
         self.compareFail = False
         if text is not None:
-            self.text = text
+            self.text = sys.intern(text)
 
     def set(self, text, fileName, line):
-        self.text = text
-        self.fileName = fileName
+        self.text = sys.intern(text)
+        self.fileName = sys.intern(fileName)
         self.line = line
         self.compareFail = False
 
@@ -21,10 +30,14 @@ class PmacToken:
         return self.text
 
     def __eq__(self, other):
+        if other.__class__ is str:
+            return self.text == other
+        elif other.__class__ is PmacToken:
+            return self.text == other.text
         return self.text == str(other)
 
     def __ne__(self, other):
-        return self.text != str(other)
+        return not self.__eq__(other)
 
     def __len__(self):
         return len(self.text)
@@ -33,18 +46,68 @@ class PmacToken:
         return self.text.lower()
 
 
+# The parts of the address either side of the node for the families of
+# variables that belong to a coordinate system or macro station node
+nodeAddressParts = {
+    "q": ("&", "q"),
+    "#": ("&", "#"),
+    "%": ("&", "%"),
+    "ms": ("ms", "i"),
+}
+addressPrefixes = {}
+
+
+def addressPrefix(family, node):
+    """Returns the address of a family and node without the number."""
+    result = addressPrefixes.get((family, node))
+    if result is None:
+        if family in nodeAddressParts:
+            before, after = nodeAddressParts[family]
+            result = f"{before}{node}{after}"
+        else:
+            result = family
+        addressPrefixes[(family, node)] = result
+    return result
+
+
+def keyAddress(key):
+    """Returns the address of the variable with a key."""
+    family, node, n = key
+    return f"{addressPrefix(family, node)}{n}"
+
+
+def keyOrder(key):
+    """Returns the sort key that puts variable keys in the order of their
+    addresses, with the numbers in numeric order."""
+    family, node, n = key
+    return (addressPrefix(family, node), n)
+
+
 class PmacVariable:
+    # A variable is made for every entry read from a PMAC or a reference
+    # file, and a view each time one held in a column is fetched, so
+    # variables have no instance dictionary.  The address is worked out from
+    # the key when it is wanted rather than held by every variable.
+    __slots__ = ("n", "v", "ro")
     spaces = "                        "
+    family = ""
 
-    def __init__(self, prefix, n, v):
-        self.typeStr = f"{prefix}{n}"
+    def __init__(self, n, v):
         self.n = n
         self.v = v
         self.ro = False
 
+    @property
+    def typeStr(self):
+        return keyAddress(self.key())
+
     def addr(self):
         return self.typeStr
 
+    def key(self):
+        """Returns the key of the variable in a PmacState."""
+        return (self.family, 0, self.n)
+
     def set(self, v):
         self.v = v
 
@@ -81,6 +144,8 @@ class PmacVariable:
 
 
 class PmacIVariable(PmacVariable):
+    __slots__ = ()
+    family = "i"
     useHexAxis = [2, 3, 4, 5, 10, 24, 25, 42, 43, 44, 55, 81, 82, 83, 84, 91, 95]
     useHexGlobal = range(8000, 8192)
     axisVarMin = 100
@@ -88,7 +153,7 @@ class PmacIVariable(PmacVariable):
     varsPerAxis = 100
 
     def __init__(self, n, v=0, ro=False):
-        PmacVariable.__init__(self, "i", n, v)
+        PmacVariable.__init__(self, n, v)
         self.ro = ro
 
     def dump(self, typ=0, comment=""):
@@ -132,8 +197,11 @@ class PmacIVariable(PmacVariable):
 
 
 class PmacMVariable(PmacVariable):
+    __slots__ = ("type", "address", "offset", "width", "format")
+    family = "m"
+
     def __init__(self, n, type="*", address=0, offset=0, width=0, format="U"):
-        PmacVariable.__init__(self, "m", n, 0)
+        PmacVariable.__init__(self, n, 0)
         self.set(type, address, offset, width, format)
 
     def dump(self, typ=0):
@@ -205,8 +273,11 @@ class PmacMVariable(PmacVariable):
 
 
 class PmacPVariable(PmacVariable):
+    __slots__ = ()
+    family = "p"
+
     def __init__(self, n, v=0):
-        PmacVariable.__init__(self, "p", n, v)
+        PmacVariable.__init__(self, n, v)
 
     def dump(self, typ=0):
         if typ == 1:
@@ -223,10 +294,16 @@ class PmacPVariable(PmacVariable):
 
 
 class PmacQVariable(PmacVariable):
+    __slots__ = ("cs",)
+    family = "q"
+
     def __init__(self, cs, n, v=0):
-        PmacVariable.__init__(self, f"&{cs}q", n, v)
+        PmacVariable.__init__(self, n, v)
         self.cs = cs
 
+    def key(self):
+        return (self.family, self.cs, self.n)
+
     def dump(self, typ=0):
         if typ == 1:
             result = f"{self.valStr()}"
@@ -242,10 +319,16 @@ class PmacQVariable(PmacVariable):
 
 
 class PmacFeedrateOverride(PmacVariable):
+    __slots__ = ("cs",)
+    family = "%"
+
     def __init__(self, cs, v=0):
-        PmacVariable.__init__(self, f"&{cs}%", 0, v)
+        PmacVariable.__init__(self, 0, v)
         self.cs = cs
 
+    def key(self):
+        return (self.family, self.cs, 0)
+
     def dump(self, typ=0):
         if typ == 1:
             result = f"{self.valStr()}"
@@ -261,11 +344,17 @@ class PmacFeedrateOverride(PmacVariable):
 
 
 class PmacMsIVariable(PmacVariable):
+    __slots__ = ("ms",)
+    family = "ms"
+
     def __init__(self, ms, n, v="", ro=False):
-        PmacVariable.__init__(self, f"ms{ms}i", n, v)
+        PmacVariable.__init__(self, n, v)
         self.ms = ms
         self.ro = ro
 
+    def key(self):
+        return (self.family, self.ms, self.n)
+
     def dump(self, typ=0):
         if typ == 1:
             result = f"{self.valStr()}"
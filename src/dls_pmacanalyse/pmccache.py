@@ -0,0 +1,124 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+
+from dls_pmaclib.dls_pmcpreprocessor import ClsPmacParser
+
+log = logging.getLogger(__name__)
+
+
+class MissingIncludeHandler(logging.Handler):
+    """Notes the include files the preprocessor could not find."""
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.missing = []
+
+    def emit(self, record):
+        if "Could not find include file" in str(record.msg):
+            self.missing.append(record.getMessage())
+
+
+def preprocess(fileName, includePaths):
+    """Expands the includes and defines of a PMC file, returning the lines
+    with the debug information that locates each line in its source file.
+    Returns None if the file cannot be opened."""
+    if includePaths is not None:
+        p = ClsPmacParser(includePaths=includePaths.split(":"))
+    else:
+        p = ClsPmacParser()
+    return p.parse(fileName, debug=True)
+
+
+class PreprocessorCache:
+    """A cache of preprocessed PMC files.  An entry records the modification
+    time and size of the main file and of every include file that it pulled
+    in, and is only used while none of them have changed.  The files are
+    found from the debug information in the preprocessed output.  The output
+    of a file with an include that could not be found is not cached, as the
+    include may appear later."""
+
+    version = 1
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+
+    def cacheFile(self, fileName, includePaths):
+        key = hashlib.sha256(
+            f"{os.path.abspath(fileName)}\0{includePaths}".encode()
+        ).hexdigest()
+        return os.path.join(self.cacheDir, f"preprocessed-{key[:32]}.json.gz")
+
+    @staticmethod
+    def fileStamp(fileName):
+        stat = os.stat(fileName)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    @staticmethod
+    def dependencies(fileName, output):
+        """Returns the files that the preprocessed output came from."""
+        result = {os.path.abspath(fileName)}
+        for line in output:
+            if line.startswith(";#* "):
+                result.add(line[4:].rsplit(" ", 1)[0])
+        return sorted(result)
+
+    def load(self, cacheFile):
+        """Returns the cached output if it is still valid, otherwise None."""
+        if not os.path.exists(cacheFile):
+            return None
+        try:
+            with gzip.open(cacheFile, "rt", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring preprocessor cache {cacheFile}: {e}")
+            return None
+        if not isinstance(data, dict) or data.get("version") != self.version:
+            return None
+        for fileName, stamp in data["dependencies"].items():
+            try:
+                if self.fileStamp(fileName) != stamp:
+                    return None
+            except OSError:
+                return None
+        return data["output"]
+
+    def save(self, cacheFile, fileName, output):
+        """Caches the preprocessed output.  Failing to write the cache is not
+        an error."""
+        try:
+            data = {
+                "version": self.version,
+                "fileName": os.path.abspath(fileName),
+                "dependencies": {
+                    f: self.fileStamp(f) for f in self.dependencies(fileName, output)
+                },
+                "output": output,
+            }
+            os.makedirs(self.cacheDir, exist_ok=True)
+            tmpFile = f"{cacheFile}.{os.getpid()}.tmp"
+            with gzip.open(tmpFile, "wt", encoding="utf-8") as file:
+                json.dump(data, file)
+            os.replace(tmpFile, cacheFile)
+        except OSError as e:
+            log.warning(f"Could not write preprocessor cache {cacheFile}: {e}")
+
+    def preprocess(self, fileName, includePaths):
+        """As the preprocess function, but using the cache."""
+        cacheFile = self.cacheFile(fileName, includePaths)
+        output = self.load(cacheFile)
+        if output is not None:
+            log.info(f"Using cached preprocessor output for {fileName}")
+            return output
+        handler = MissingIncludeHandler()
+        preprocessorLog = logging.getLogger("dls_pmaclib")
+        preprocessorLog.addHandler(handler)
+        try:
+            output = preprocess(fileName, includePaths)
+        finally:
+            preprocessorLog.removeHandler(handler)
+        if output is not None and len(handler.missing) == 0:
+            self.save(cacheFile, fileName, output)
+        return output
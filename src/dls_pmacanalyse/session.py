@@ -0,0 +1,171 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+
+class SessionRecorder:
+    """Wraps a PMAC interface, recording every command sent, its reply and
+    the time the reply took.  The session is written to a gzip compressed
+    file of JSON lines when the connection is closed: a header followed by a
+    [command, reply, status, seconds] list for each command.  The header
+    keeps the range command block sizes the readout started from, as they
+    decide the commands it sends."""
+
+    formatName = "pmac-session"
+    version = 1
+
+    def __init__(self, pti, fileName, blockSizes=None):
+        self.pti = pti
+        self.fileName = fileName
+        self.blockSizes = dict(blockSizes or {})
+        self.host = ""
+        self.port = None
+        self.records = []
+
+    def setConnectionParams(self, host, port):
+        self.host = host
+        self.port = port
+        self.pti.setConnectionParams(host, port)
+
+    def connect(self):
+        return self.pti.connect()
+
+    def disconnect(self):
+        msg = self.pti.disconnect()
+        self.save()
+        return msg
+
+    def sendCommand(self, command):
+        start = time.perf_counter()
+        (returnStr, status) = self.pti.sendCommand(command)
+        self.record(command, returnStr, status, time.perf_counter() - start)
+        return (returnStr, status)
+
+    def record(self, command, returnStr, status, seconds):
+        self.records.append([command, returnStr, status, round(seconds, 6)])
+
+    def save(self):
+        """Writes the recorded session."""
+        log.info(f"Writing session file {self.fileName}")
+        header = {
+            "format": self.formatName,
+            "version": self.version,
+            "host": self.host,
+            "port": self.port,
+            "blockSizes": self.blockSizes,
+        }
+        with gzip.open(self.fileName, "wt", encoding="utf-8") as file:
+            file.write(json.dumps(header) + "\n")
+            for record in self.records:
+                file.write(json.dumps(record) + "\n")
+
+
+class AsyncSessionRecorder(SessionRecorder):
+    """The asyncio counterpart of SessionRecorder."""
+
+    async def connect(self):
+        return await self.pti.connect()
+
+    async def disconnect(self):
+        await self.pti.disconnect()
+        self.save()
+
+    async def sendCommand(self, command):
+        start = time.perf_counter()
+        (returnStr, status) = await self.pti.sendCommand(command)
+        self.record(command, returnStr, status, time.perf_counter() - start)
+        return (returnStr, status)
+
+
+class SessionPlayer:
+    """Serves a session recorded by SessionRecorder in place of a PMAC
+    interface.  Replies are given in the recorded order, so a readout that
+    sends the same commands sees exactly the recorded PMAC.  A command that
+    differs from the recording is answered with the next recorded reply to
+    the same command if there is one, otherwise with an I/O error.  With
+    realTime the recorded reply times are reproduced, otherwise replies are
+    immediate."""
+
+    def __init__(self, fileName, realTime=False):
+        self.fileName = fileName
+        self.realTime = realTime
+        self.records = []
+        self.blockSizes = {}
+        self.index = 0
+        self.numMismatches = 0
+
+    def setConnectionParams(self, host, port):
+        pass
+
+    def connect(self):
+        """Loads the session.  Returns None on success or an error message
+        on failure."""
+        if not os.path.exists(self.fileName):
+            return f"ERROR: no recorded session {self.fileName}"
+        try:
+            with gzip.open(self.fileName, "rt", encoding="utf-8") as file:
+                header = json.loads(file.readline())
+                if (
+                    header.get("format") != SessionRecorder.formatName
+                    or header.get("version") != SessionRecorder.version
+                ):
+                    return f"ERROR: unknown session file format {self.fileName}"
+                self.blockSizes = header.get("blockSizes", {})
+                self.records = [json.loads(line) for line in file]
+        except (OSError, ValueError) as e:
+            return f"ERROR: could not read session {self.fileName}: {e}"
+        self.index = 0
+        self.numMismatches = 0
+        log.info(f"Replaying {len(self.records)} commands from {self.fileName}")
+        return None
+
+    def disconnect(self):
+        if self.numMismatches > 0:
+            log.warning(
+                f"{self.numMismatches} commands did not match the recorded "
+                f"session {self.fileName}"
+            )
+
+    def nextReply(self, command):
+        """Returns the recorded (returnStr, status, seconds) for a command."""
+        if self.index < len(self.records) and self.records[self.index][0] == command:
+            record = self.records[self.index]
+            self.index += 1
+        else:
+            self.numMismatches += 1
+            for i in range(self.index, len(self.records)):
+                if self.records[i][0] == command:
+                    record = self.records[i]
+                    self.index = i + 1
+                    break
+            else:
+                log.debug(f"Command not in recorded session: {command!r}")
+                return ("I/O error during comm with PMAC: not recorded", False, 0.0)
+        return (record[1], record[2], record[3])
+
+    def sendCommand(self, command):
+        (returnStr, status, seconds) = self.nextReply(command)
+        if self.realTime:
+            time.sleep(seconds)
+        return (returnStr, status)
+
+
+class AsyncSessionPlayer(SessionPlayer):
+    """The asyncio counterpart of SessionPlayer."""
+
+    async def connect(self):
+        return SessionPlayer.connect(self)
+
+    async def disconnect(self):
+        SessionPlayer.disconnect(self)
+
+    async def sendCommand(self, command):
+        (returnStr, status, seconds) = self.nextReply(command)
+        if self.realTime:
+            await asyncio.sleep(seconds)
+        return (returnStr, status)
@@ -0,0 +1,407 @@
+import asyncio
+import getopt
+import logging
+import os
+import random
+import re
+import struct
+import sys
+
+from dls_pmacanalyse.errors import ArgumentError
+from dls_pmacanalyse.pmacstate import PmacState
+
+log = logging.getLogger(__name__)
+
+helpText = """
+  Simulate a Delta-Tau PMAC motor controller for offline readouts.
+
+  Syntax:
+    dls-pmacsim [<options>] [<pmcFile>...]
+        where <options> is one or more of:
+        -h, --help                Print the help text and exit
+        --host=<ip>               The interface to listen on, default localhost
+        --port=<num>              The port to listen on, default 1025
+        --ts                      Talk the terminal server protocol instead of the
+                                  TCP/IP protocol
+        --geobrick                Simulate a Geobrick rather than a VME PMAC
+        --nofactorydefs           Do not load the factory settings
+        --include=<paths>         Colon separated include paths for PMC files
+        --latency=<seconds>       Delay before each reply
+        --bandwidth=<bytes/sec>   Limit the rate at which replies are sent
+        --errorrate=<fraction>    Fraction of command lines answered with an error
+        --seed=<num>              Seed for the error injection
+        --loglevel=<level>        Set the logging level
+        <pmcFile> is a PMC file, typically a backup written by dls-pmacanalyse,
+        that is loaded over the factory settings.
+  """
+
+CHAR_ACK = "\x06"
+CHAR_RETURN = "\r"
+
+# The commands understood by the simulator, tried in order against the start
+# of the remaining command line
+commandRegExps = [
+    ("assign", re.compile(r"i(\d+)=(\$?[0-9a-f.\-]+)")),
+    (
+        "list",
+        re.compile(
+            r"(?:&(\d+))?list (plc|program|forward|inverse)(?: ?(\d+))?,(\d+),(\d+)"
+        ),
+    ),
+    ("qrange", re.compile(r"&(\d+)q(\d+)\.\.(\d+)")),
+    ("axisdef", re.compile(r"&(\d+)#(\d+)->")),
+    ("feedrate", re.compile(r"&(\d+)%")),
+    ("range", re.compile(r"([ipm])(\d+)\.\.(\d+)(->)?")),
+    ("var", re.compile(r"([ipm])(\d+)(->)?")),
+    ("position", re.compile(r"#(\d+)p")),
+    ("msvar", re.compile(r"ms(\d+),i(\d+)")),
+    ("cid", re.compile(r"cid")),
+    ("ver", re.compile(r"ver")),
+]
+
+
+class PmacSimulator:
+    """Answers the subset of on-line commands used by a hardware readout from
+    a PmacState, over either the TCP/IP or the terminal server protocol.
+    Latency, bandwidth and error injection allow the readout of many PMACs
+    to be benchmarked without any hardware."""
+
+    version = "1.947"
+    getresponseRequest = 0xBF
+    getbufferRequest = 0xC5
+    bufferLength = 1400
+    # The macro IC base addresses are reported in hex
+    hexIVariables = (20, 21, 22, 23)
+
+    def __init__(
+        self,
+        state,
+        geobrick=False,
+        latency=0.0,
+        bandwidth=None,
+        errorRate=0.0,
+        seed=None,
+    ):
+        self.state = state
+        self.geobrick = geobrick
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.errorRate = errorRate
+        self.random = random.Random(seed)
+        self.numRequests = 0
+        self.numBytes = 0
+        self.listings = {}
+        # Macro station nodes that answer, the others give an error.  They are
+        # the nodes of the MS I variable columns that define any variable.
+        self.macroStations = {
+            node
+            for (family, node), column in self.state.vars.columns.items()
+            if family == "ms" and any(column.kinds)
+        }
+
+    @staticmethod
+    def loadState(fileNames, geobrick=False, useFactoryDefs=True, includePaths=None):
+        """Returns a PmacState loaded from the factory settings followed by
+        the given PMC files."""
+        state = PmacState("simulator")
+        if useFactoryDefs:
+            if geobrick:
+                factorySettings = "factorySettings_geobrick.pmc"
+            else:
+                factorySettings = "factorySettings_pmac.pmc"
+            state.loadPmcFileWithPreprocess(
+                os.path.join(os.path.dirname(__file__), factorySettings),
+                includePaths,
+            )
+        for fileName in fileNames:
+            state.loadPmcFileWithPreprocess(fileName, includePaths)
+        return state
+
+    def formatNumber(self, v):
+        if isinstance(v, float):
+            result = f"{v:.12f}".rstrip("0")
+            if result.endswith("."):
+                result += "0"
+            return result
+        return str(v)
+
+    def getProgram(self, kind, n, cs):
+        if kind == "plc":
+            return self.state.getPlcProgramNoCreate(n)
+        elif kind == "program":
+            return self.state.getMotionProgramNoCreate(n)
+        elif kind == "forward":
+            return self.state.getForwardKinematicProgramNoCreate(cs)
+        else:
+            return self.state.getInverseKinematicProgramNoCreate(cs)
+
+    def getListing(self, kind, n, cs):
+        """Returns the offsets and lines of a program, or None if it is not
+        defined.  A program read from a PMAC keeps its original listing,
+        otherwise one is made up by counting a word for each token."""
+        key = (kind, n, cs)
+        if key not in self.listings:
+            prog = self.getProgram(kind, n, cs)
+            if prog is None or (prog.isEmpty() and not prog.lines):
+                self.listings[key] = None
+            elif prog.lines and prog.offsets:
+                self.listings[key] = list(
+                    zip([int(o) for o in prog.offsets], prog.lines, strict=True)
+                )
+            else:
+                listing = []
+                offset = 0
+                for line in prog.valueText().split("\n"):
+                    if line:
+                        listing.append((offset, line))
+                        offset += len(line.split()) + 1
+                self.listings[key] = listing
+        return self.listings[key]
+
+    def matchCommand(self, line):
+        """Returns the kind and match of the command at the start of a line,
+        or (None, None) if it is not understood."""
+        for kind, regExp in commandRegExps:
+            match = regExp.match(line)
+            if match:
+                return kind, match
+        return None, None
+
+    def answer(self, kind, match):
+        """Returns the lines answering a single command, or None if the
+        command gives an error."""
+        state = self.state
+        if kind == "assign":
+            state.getIVariable(int(match.group(1))).set(match.group(2))
+            return []
+        elif kind == "list":
+            cs, prog, n, start, length = match.groups()
+            listing = self.getListing(
+                prog, int(n) if n else None, int(cs) if cs else None
+            )
+            start = int(start)
+            # Listing beyond the end of a program is an error
+            if listing is None or start > listing[-1][0]:
+                return None
+            end = start + int(length)
+            result = []
+            for index, (offset, line) in enumerate(listing):
+                if offset >= end:
+                    # Like the PMAC, the line after the window is included
+                    # as the window may end part way through it
+                    result.append(f"{offset}:{line}")
+                    break
+                # The line containing the start is listed in full
+                if index + 1 == len(listing) or listing[index + 1][0] > start:
+                    result.append(f"{offset}:{line}")
+            return result
+        elif kind == "qrange":
+            cs, first, last = (int(g) for g in match.groups())
+            return [
+                self.formatNumber(state.getQVariable(cs, q).v)
+                for q in range(first, last + 1)
+            ]
+        elif kind == "axisdef":
+            axisDef = state.getCsAxisDefNoCreate(
+                int(match.group(1)), int(match.group(2))
+            )
+            if axisDef is None:
+                return ["0"]
+            return [axisDef.valueText().strip() or "0"]
+        elif kind == "feedrate":
+            var = state.getFeedrateOverrideNoCreate(int(match.group(1)))
+            return ["100" if var is None else self.formatNumber(var.v)]
+        elif kind in ("range", "var"):
+            t = match.group(1)
+            if kind == "range":
+                first, last, arrow = (
+                    int(match.group(2)),
+                    int(match.group(3)),
+                    match.group(4),
+                )
+            else:
+                first, arrow = int(match.group(2)), match.group(3)
+                last = first
+            if last < first or last > 8191:
+                return None
+            result = []
+            for n in range(first, last + 1):
+                var = state.getVar(t, n)
+                if t == "m" and not arrow:
+                    result.append(self.formatNumber(var.v))
+                elif t == "i" and n in self.hexIVariables and isinstance(var.v, int):
+                    result.append(f"${var.v:x}")
+                else:
+                    result.append(var.valStr())
+            return result
+        elif kind == "position":
+            return ["0"]
+        elif kind == "msvar":
+            ms, n = int(match.group(1)), int(match.group(2))
+            if ms not in self.macroStations:
+                return None
+            var = state.getVarNoCreate2("ms", ms, "i", n)
+            if var is None or var.v == "":
+                return ["0"]
+            return [self.formatNumber(var.v)]
+        elif kind == "cid":
+            return ["603382" if self.geobrick else "602413"]
+        else:
+            return [self.version]
+
+    def answerLine(self, line):
+        """Returns the reply to a command line.  Like the PMAC, commands are
+        executed in turn and the first error abandons the rest of the line."""
+        self.numRequests += 1
+        if self.errorRate and self.random.random() < self.errorRate:
+            return "\x07ERR001\r"
+        line = line.strip().lower()
+        result = ""
+        while line:
+            kind, match = self.matchCommand(line)
+            answers = None if match is None else self.answer(kind, match)
+            if answers is None:
+                return result + "\x07ERR003\r"
+            result += "".join(answer + CHAR_RETURN for answer in answers)
+            line = line[match.end() :].lstrip()
+        return result + CHAR_ACK
+
+    async def delay(self, reply):
+        """Waits for the configured latency and the time the reply would take
+        to transmit."""
+        self.numBytes += len(reply)
+        seconds = self.latency
+        if self.bandwidth:
+            seconds += len(reply) / self.bandwidth
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+
+    async def serveEthernet(self, reader, writer):
+        """Serves a connection using the VR_PMAC_GETRESPONSE protocol, long
+        replies being collected a buffer at a time with VR_PMAC_GETBUFFER."""
+        pending = b""
+        try:
+            while True:
+                header = await reader.readexactly(8)
+                request, length = header[1], struct.unpack(">H", header[6:8])[0]
+                if request == self.getresponseRequest:
+                    command = (await reader.readexactly(length)).decode()
+                    reply = self.answerLine(command)
+                    await self.delay(reply)
+                    pending = reply.encode()
+                elif request != self.getbufferRequest:
+                    log.warning(f"Unknown request {request:#x}")
+                    pending = b"\x07ERR003\r"
+                writer.write(pending[: self.bufferLength])
+                await writer.drain()
+                pending = pending[self.bufferLength :]
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serveTelnet(self, reader, writer):
+        """Serves a connection as a terminal server would, a command per
+        line."""
+        try:
+            while True:
+                data = await reader.readuntil(b"\r")
+                command = data.decode().lstrip("\n")
+                reply = self.answerLine(command)
+                await self.delay(reply)
+                writer.write(reply.encode())
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="localhost", port=1025, termServ=False):
+        """Starts listening, returning the asyncio server."""
+        if termServ:
+            handler = self.serveTelnet
+        else:
+            handler = self.serveEthernet
+        server = await asyncio.start_server(handler, host, port)
+        log.warning(f"Simulating a PMAC on {host} port {port}")
+        return server
+
+
+def main():
+    """Main entry point of the simulator."""
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
+    try:
+        opts, args = getopt.gnu_getopt(
+            sys.argv[1:],
+            "h",
+            [
+                "help",
+                "host=",
+                "port=",
+                "ts",
+                "geobrick",
+                "nofactorydefs",
+                "include=",
+                "latency=",
+                "bandwidth=",
+                "errorrate=",
+                "seed=",
+                "loglevel=",
+            ],
+        )
+    except getopt.GetoptError as err:
+        raise ArgumentError(str(err))
+    host = "localhost"
+    port = 1025
+    termServ = False
+    geobrick = False
+    useFactoryDefs = True
+    includePaths = None
+    latency = 0.0
+    bandwidth = None
+    errorRate = 0.0
+    seed = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print(helpText)
+            return
+        elif o == "--host":
+            host = a
+        elif o == "--port":
+            port = int(a)
+        elif o == "--ts":
+            termServ = True
+        elif o == "--geobrick":
+            geobrick = True
+        elif o == "--nofactorydefs":
+            useFactoryDefs = False
+        elif o == "--include":
+            includePaths = a
+        elif o == "--latency":
+            latency = float(a)
+        elif o == "--bandwidth":
+            bandwidth = float(a)
+        elif o == "--errorrate":
+            errorRate = float(a)
+        elif o == "--seed":
+            seed = int(a)
+        elif o == "--loglevel":
+            logging.getLogger().setLevel(a.upper())
+    state = PmacSimulator.loadState(args, geobrick, useFactoryDefs, includePaths)
+    simulator = PmacSimulator(state, geobrick, latency, bandwidth, errorRate, seed)
+
+    async def serve():
+        server = await simulator.start(host, port, termServ)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import time
+
+
+class PhaseTiming:
+    """The commands sent during one phase of a readout."""
+
+    def __init__(self, name):
+        self.name = name
+        self.commands = 0
+        self.seconds = 0.0
+        self.maxSeconds = 0.0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+
+    def addCommand(self, seconds, bytesSent, bytesReceived):
+        self.commands += 1
+        self.seconds += seconds
+        self.maxSeconds = max(self.maxSeconds, seconds)
+        self.bytesSent += bytesSent
+        self.bytesReceived += bytesReceived
+
+    def summary(self):
+        """Returns the timing of the phase as a dictionary."""
+        return {
+            "commands": self.commands,
+            "seconds": round(self.seconds, 6),
+            "maxSeconds": round(self.maxSeconds, 6),
+            "bytesSent": self.bytesSent,
+            "bytesReceived": self.bytesReceived,
+        }
+
+
+class ReadoutTiming:
+    """Accumulates the latency of, and the bytes carried by, every command
+    sent during a hardware readout.  Commands are charged to the innermost
+    phase entered, so a helper such as doMsIvars that is timed as a phase of
+    its own is reported separately from the phase that uses it.  Commands
+    sent outside any phase are charged to the "other" phase."""
+
+    def __init__(self):
+        self.phases = {}
+        self.stack = []
+        self.startTime = None
+        self.wallSeconds = 0.0
+
+    def start(self):
+        self.phases = {}
+        self.stack = []
+        self.startTime = time.perf_counter()
+        self.wallSeconds = 0.0
+
+    def stop(self):
+        if self.startTime is not None:
+            self.wallSeconds = time.perf_counter() - self.startTime
+            self.startTime = None
+
+    def enterPhase(self, name):
+        self.stack.append(name)
+
+    def exitPhase(self):
+        self.stack.pop()
+
+    def addCommand(self, seconds, bytesSent, bytesReceived):
+        name = self.stack[-1] if self.stack else "other"
+        if name not in self.phases:
+            self.phases[name] = PhaseTiming(name)
+        self.phases[name].addCommand(seconds, bytesSent, bytesReceived)
+
+    def total(self):
+        """Returns the timing of the whole readout as a PhaseTiming."""
+        total = PhaseTiming("total")
+        for phase in self.phases.values():
+            total.commands += phase.commands
+            total.seconds += phase.seconds
+            total.maxSeconds = max(total.maxSeconds, phase.maxSeconds)
+            total.bytesSent += phase.bytesSent
+            total.bytesReceived += phase.bytesReceived
+        return total
+
+    def summary(self):
+        """Returns the timing of the readout as a dictionary suitable for
+        writing as JSON."""
+        result = self.total().summary()
+        result["wallSeconds"] = round(self.wallSeconds, 6)
+        result["phases"] = {
+            name: phase.summary() for name, phase in self.phases.items()
+        }
+        return result
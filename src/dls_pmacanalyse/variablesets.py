@@ -0,0 +1,123 @@
+from dls_pmacanalyse.errors import ConfigError
+
+
+class StrideSet:
+    """A set of variable numbers held as the ranges that were added to and
+    removed from it, in order, rather than as the numbers themselves.  A
+    number is a member if the last range that covers it was added.  The
+    members of another set may be added as a whole, in which case a snapshot
+    of that set stands in place of a range."""
+
+    def __init__(self):
+        self.ops = []
+
+    @staticmethod
+    def stride(start, count, increment):
+        """Returns the range of count numbers from start in steps of the
+        increment.  An increment of zero names start alone."""
+        if count <= 0:
+            return range(0)
+        if increment == 0:
+            return range(start, start + 1)
+        return range(start, start + count * increment, increment)
+
+    def add(self, start, count, increment):
+        self.ops.append((True, self.stride(start, count, increment)))
+
+    def remove(self, start, count, increment):
+        self.ops.append((False, self.stride(start, count, increment)))
+
+    def update(self, other):
+        """Adds the members of the other set."""
+        self.ops.append((True, other.copy()))
+
+    def copy(self):
+        result = StrideSet()
+        result.ops = list(self.ops)
+        return result
+
+    def __contains__(self, n):
+        for include, members in reversed(self.ops):
+            if n in members:
+                return include
+        return False
+
+    def __bool__(self):
+        return any(include for include, _ in self.ops)
+
+    def mask(self, length):
+        """Returns a bytearray of the given length in which the entries of
+        the members are one and the rest zero."""
+        result = bytearray(length)
+        for include, members in self.ops:
+            if isinstance(members, range):
+                count = len(range(length)[members.start : members.stop : members.step])
+                result[members.start : members.stop : members.step] = (
+                    b"\x01" if include else b"\x00"
+                ) * count
+            else:
+                whole = int.from_bytes(result, "little")
+                part = int.from_bytes(members.mask(length), "little")
+                whole = whole | part if include else whole & ~part
+                result[:] = whole.to_bytes(length, "little")
+        return result
+
+
+class VariableSet:
+    """The variables named by the nocompare and compare specifications of
+    the configuration, held as a StrideSet for each family and node, so
+    that a specification such as i0..8191 costs the same as i0."""
+
+    def __init__(self):
+        self.families = {}
+
+    @staticmethod
+    def familyNodes(varType, nodeList):
+        """Returns the (family, node) pairs named by the variable type and
+        node list of a parsed variable specification."""
+        if varType in ("i", "p", "m"):
+            return [(varType, 0)]
+        elif varType == "ms":
+            return [("ms", ms) for ms in nodeList]
+        elif varType == "&":
+            return [("q", cs) for cs in nodeList]
+        raise ConfigError(f"Cannot decode variable type {repr(varType)}")
+
+    def strideSet(self, family, node):
+        """Returns the set of numbers for the family and node, creating it
+        if need be."""
+        result = self.families.get((family, node))
+        if result is None:
+            result = StrideSet()
+            self.families[(family, node)] = result
+        return result
+
+    def add(self, varType, nodeList, start, count, increment):
+        """Adds the variables of a parsed variable specification."""
+        if count > 0:
+            for family, node in self.familyNodes(varType, nodeList):
+                self.strideSet(family, node).add(start, count, increment)
+
+    def remove(self, varType, nodeList, start, count, increment):
+        """Removes the variables of a parsed variable specification."""
+        if count > 0:
+            for family, node in self.familyNodes(varType, nodeList):
+                self.strideSet(family, node).remove(start, count, increment)
+
+    def update(self, other):
+        """Adds the variables of the other set."""
+        for (family, node), members in other.families.items():
+            self.strideSet(family, node).update(members)
+
+    def __contains__(self, key):
+        family, node, n = key
+        members = self.families.get((family, node))
+        return members is not None and n in members
+
+    def mask(self, family, node, length):
+        """Returns a mask of the given length for the family and node, as
+        StrideSet.mask, or None if none of its variables are in the set."""
+        members = self.families.get((family, node))
+        if not members:
+            return None
+        return members.mask(length)
@@ -0,0 +1,111 @@
+"""Measures the lexer throughput on the factory settings files.
+
+Run with ``python tests/benchmark_lexer.py [file.pmc ...]``.  The token
+stream is checked against the original linear scan of the token tables, and
+the tokens per second of both are reported."""
+
+import os
+import sys
+import time
+
+from dls_pmacanalyse.errors import LexerError
+from dls_pmacanalyse.pmaclexer import PmacLexer
+
+
+class LinearScanLexer(PmacLexer):
+    """The lexer with the original findToken, which tries every entry of the
+    token tables in turn."""
+
+    def findToken(self, text):
+        bestToken = ""
+        if text[0].isdigit():
+            isNumber = True
+            hasDot = False
+            pos = 0
+            curToken = ""
+            while pos < len(text) and isNumber:
+                ch = text[pos]
+                if ch.isdigit():
+                    curToken += ch
+                elif not hasDot and ch == ".":
+                    hasDot = True
+                    curToken += ch
+                else:
+                    isNumber = False
+                pos += 1
+            if len(curToken) > 0 and curToken[-1] == ".":
+                curToken = curToken[:-1]
+            bestToken = curToken
+        elif text[0] == "$":
+            pos = 1
+            curToken = "$"
+            isNumber = True
+            while pos < len(text) and isNumber:
+                ch = text[pos]
+                if ch in "0123456789ABCDEF":
+                    curToken += ch
+                else:
+                    isNumber = False
+                pos += 1
+            bestToken = curToken
+        elif text[0] == '"':
+            curToken = '"'
+            pos = 1
+            noTerminator = True
+            while pos < len(text) and noTerminator:
+                ch = text[pos]
+                curToken += ch
+                if ch == '"':
+                    noTerminator = False
+                pos += 1
+            if noTerminator:
+                raise LexerError(text, self.fileName, self.line)
+            bestToken = curToken
+        else:
+            for t in PmacLexer.tokens:
+                if len(t) > len(bestToken) and text.startswith(t):
+                    bestToken = t
+            for t in PmacLexer.shortTokens:
+                if len(t) > len(bestToken) and text.startswith(t):
+                    bestToken = t
+        if len(bestToken) == 0:
+            raise LexerError(text, self.fileName, self.line)
+        return bestToken
+
+
+def tokenStream(tokens):
+    return [(str(t), t.fileName, t.line) for t in tokens]
+
+
+def benchmark(lexerClass, lines, repeats):
+    """Returns the tokens and the best tokens per second over the repeats."""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        tokens = lexerClass(lines).remainingTokens()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return tokens, len(tokens) / best
+
+
+def main():
+    srcDir = os.path.dirname(sys.modules[PmacLexer.__module__].__file__)
+    fileNames = sys.argv[1:] or [
+        os.path.join(srcDir, "factorySettings_pmac.pmc"),
+        os.path.join(srcDir, "factorySettings_geobrick.pmc"),
+    ]
+    lines = []
+    for fileName in fileNames:
+        with open(fileName) as file:
+            lines += file.readlines()
+    before, beforeRate = benchmark(LinearScanLexer, lines, 3)
+    after, afterRate = benchmark(PmacLexer, lines, 3)
+    if tokenStream(before) != tokenStream(after):
+        sys.exit("Token streams differ")
+    print(f"{len(lines)} lines, {len(after)} tokens")
+    print(f"linear scan: {beforeRate:12.0f} tokens/s")
+    print(f"regexp:      {afterRate:12.0f} tokens/s ({afterRate / beforeRate:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import pickle
+
+from dls_pmacanalyse.analyse import Analyse, loadPmacFiles
+from dls_pmacanalyse.globalconfig import GlobalConfig
+from dls_pmacanalyse.pmac import Pmac
+from dls_pmacanalyse.pmacstate import PmacState
+
+
+def test_factory_settings_cache(tmp_path):
+    settings = tmp_path / "factorySettings_test.pmc"
+    settings.write_text("i130=2000\np100=5\n")
+    config = GlobalConfig()
+    config.cacheDir = str(tmp_path / "cache")
+    analyse = Analyse(config)
+
+    parsed = PmacState("parsed")
+    analyse.loadFactorySettings(parsed, str(settings), None)
+    cacheFiles = list((tmp_path / "cache").glob("*/*.pickle"))
+    assert len(cacheFiles) == 1
+
+    cached = PmacState("cached")
+    assert analyse.loadCachedFactorySettings(cached, str(cacheFiles[0]))
+    assert cached.getIVariable(130).v == 2000
+    assert cached.dump() == parsed.dump()
+
+    # A changed settings file replaces the cache entry
+    settings.write_text("i130=3000\n")
+    changed = PmacState("changed")
+    analyse.loadFactorySettings(changed, str(settings), None)
+    assert changed.getIVariable(130).v == 3000
+    assert len(list((tmp_path / "cache").glob("*/*.pickle"))) == 1
+
+    # Other include paths keep an entry of their own, and both are used
+    include = PmacState("include")
+    analyse.loadFactorySettings(include, str(settings), str(tmp_path))
+    assert len(list((tmp_path / "cache").glob("*/*.pickle"))) == 2
+    analyse.loadFactorySettings(PmacState("again"), str(settings), None)
+    assert len(list((tmp_path / "cache").glob("*/*.pickle"))) == 2
+
+
+def test_load_files_before_readout(tmp_path):
+    reference = tmp_path / "ref.pmc"
+    reference.write_text("i130=2000\n")
+    pmac = Pmac("test")
+    pmac.setNoFactoryDefs()
+    pmac.setReference(str(reference))
+    hardwareVars, referenceVars = loadPmacFiles(pickle.dumps(pmac), None, None, True)
+    assert hardwareVars == {}
+    assert referenceVars[("i", 0, 130)].v == 2000
+
+    # An inline expression needs the hardware, so must wait for the readout
+    reference.write_text("i130=i131*2\n")
+    assert loadPmacFiles(pickle.dumps(pmac), None, None, True) is None
@@ -0,0 +1,49 @@
+from dls_pmacanalyse.pmaclexer import PmacLexer
+
+SOURCE = """
+i130=12000 ; proportional gain
+p100=$3FF&2
+open prog 10 clr
+CMDP"#1J+"
+if(p1>1.5)dwe 10.25
+end while endi
+m1->x:$078000,0,24,s
+&1#3->100X
+ccbuf$$$***
+"""
+
+
+def test_lexer_tokens():
+    lexer = PmacLexer(SOURCE.splitlines(keepends=True))
+    assert [str(t) for t in lexer.remainingTokens()] == [
+        "\n",
+        *["I", "130", "=", "12000", "\n"],
+        *["P", "100", "=", "$3FF", "&", "2", "\n"],
+        *["OPEN", "PROGRAM", "10", "CLEAR", "\n"],
+        *["COMMANDP", '"#1J+"', "\n"],
+        *["IF", "(", "P", "1", ">", "1.5", ")", "DWELL", "10.25", "\n"],
+        *["ENDWHILE", "ENDIF", "\n"],
+        *["M", "1", "->", "X", ":", "$078000", ",", "0", ",", "24", ",", "S", "\n"],
+        *["&", "1", "#", "3", "->", "100", "X", "\n"],
+        *["CCBUF", "$", "$", "$", "*", "*", "*", "\n"],
+    ]
+    assert [t.line for t in lexer.remainingTokens()][:6] == [1, 2, 2, 2, 2, 2]
+
+
+def test_lexer_streams_source():
+    linesRead = []
+
+    def source():
+        for i, line in enumerate([";#* ref.pmc 10\n", "p1=1\n", "end\n", "if\n"] * 3):
+            linesRead.append(i)
+            yield line
+
+    lexer = PmacLexer(source())
+    t = lexer.getToken()
+    assert (str(t), t.fileName, t.line) == ("P", "ref.pmc", 10)
+    assert len(linesRead) == 2
+    lexer.putToken(t)
+    assert lexer.getToken("P") is t
+    tokens = [str(t) for t in lexer.remainingTokens()]
+    assert tokens[:8] == ["1", "=", "1", "\n", "END", "ENDIF", "\n", "P"]
+    assert len(linesRead) == 12
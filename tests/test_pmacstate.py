@@ -0,0 +1,197 @@
+import io
+import pickle
+from functools import cmp_to_key
+
+from dls_pmacanalyse.pmacstate import PmacState
+from dls_pmacanalyse.pmacvariables import (
+    PmacFeedrateOverride,
+    PmacIVariable,
+    PmacMsIVariable,
+    PmacMVariable,
+    PmacQVariable,
+    PmacToken,
+    keyAddress,
+    keyOrder,
+)
+from dls_pmacanalyse.utils import numericSort
+from dls_pmacanalyse.variablesets import VariableSet
+from dls_pmacanalyse.webpage import WebPage
+
+
+def test_state_layered_over_base():
+    base = PmacState("base")
+    base.getIVariable(130).set(2000)
+    base.getPVariable(1).set(5)
+    state = PmacState("state")
+    state.setBase(base)
+
+    # The variable is shared with the base rather than copied
+    assert state.getVarNoCreate("i", 130).column is base.vars.column("i", 0)
+    assert state.vars == {}
+    # Fetching a variable to change it copies it from the base
+    state.getIVariable(130).set(3000)
+    assert state.getIVariable(130).v == 3000
+    assert base.getIVariable(130).v == 2000
+    state.getPVariable(2).set(7)
+    assert sorted(state.vars) == [("i", 0, 130), ("p", 0, 2)]
+    assert sorted(state.allVars()) == [("i", 0, 130), ("p", 0, 1), ("p", 0, 2)]
+    assert state.dump() == "i130=3000\np1=5\np2=7\n"
+
+
+def test_state_columns():
+    state = PmacState("state")
+    state.getIVariable(10).set(5)
+    state.getIVariable(11).set(2.5)
+    state.getIVariable(12).set("text")
+    state.getIVariable(13).set(2**60)
+    state.addVar(PmacIVariable(14, 7, ro=True))
+    state.getPVariable(9000).set(1)
+    state.getQVariable(2, 5).set(0.5)
+    state.getMVariable(1).set(PmacToken("X"), 0x78000, 4, 8, PmacToken("S"))
+
+    copy = pickle.loads(pickle.dumps(state))
+    assert [copy.getIVariable(i).v for i in range(10, 15)] == [5, 2.5, "text", 2**60, 7]
+    assert isinstance(copy.getIVariable(10).v, int)
+    assert copy.getIVariable(14).ro
+    assert copy.getVarNoCreate("i", 15) is None
+    assert copy.getVarNoCreate("p", 9000).v == 1
+    assert copy.getQVariable(2, 5).dump() == "&2q5=0.5\n"
+    assert copy.getMVariable(1).dump() == "m1->X:$78000,4,8,S\n"
+    assert sorted(copy.vars) == [
+        ("i", 0, 10),
+        ("i", 0, 11),
+        ("i", 0, 12),
+        ("i", 0, 13),
+        ("i", 0, 14),
+        ("m", 0, 1),
+        ("p", 0, 9000),
+        ("q", 2, 5),
+    ]
+    del copy.vars[("i", 0, 12)]
+    assert ("i", 0, 12) not in copy.vars
+    assert state.getIVariable(12).v == "text"
+
+
+def test_state_compare():
+    reference = PmacState("reference")
+    hardware = PmacState("hardware")
+    for state in (reference, hardware):
+        for n in range(200):
+            state.getPVariable(n).set(n * 0.5)
+    hardware.getPVariable(10).set(5.000001)  # within the tolerance
+    hardware.getPVariable(11).set(6.0)
+    hardware.getPVariable(12).set(-6.000001)  # negative, so compared exactly
+    reference.getPVariable(12).set(-6.0)
+    hardware.getPVariable(13).set("$10")
+    hardware.addVar(PmacIVariable(20, 3, ro=True))
+    reference.getIVariable(20).set(4)
+    reference.getIVariable(21).set(1)
+    hardware.getPVariable(150).set(1)
+    hardware.getMsIVariable(0, 910).set(2)
+    reference.getMsIVariable(0, 910).set(3)
+    hardware.getMVariable(1).set("X", 0x78000, 4, 1, "U")
+    reference.getMVariable(1).setValue(7)
+    hardware.getMVariable(1).setValue(8)
+    noCompare = VariableSet()
+    noCompare.add("p", [], 150, 1, 1)
+
+    fixFile = io.StringIO()
+    assert not hardware.compare(
+        reference, noCompare, "P", WebPage("P", "P.htm"), fixFile, None
+    )
+    assert fixFile.getvalue() == (
+        "i21=1\nm1->*\nms0,i910=3\np11=5.5\np12=-6.0\np13=6.5\n"
+    )
+
+
+def test_key_order():
+    keys = [
+        ("i", 0, 7),
+        ("i", 0, 130),
+        ("inv", 0, 1),
+        ("m", 0, 2),
+        ("ms", 0, 910),
+        ("ms", 16, 2),
+        ("p", 0, 12),
+        ("plc", 0, 3),
+        ("q", 2, 5),
+        ("q", 10, 1),
+        ("%", 2, 0),
+        ("#", 1, 3),
+    ]
+    addrs = sorted((keyAddress(k) for k in keys), key=cmp_to_key(numericSort))
+    assert [keyAddress(k) for k in sorted(keys, key=keyOrder)] == addrs
+
+
+def test_variable_set():
+    noCompare = VariableSet()
+    noCompare.add("i", [], 0, 8192, 1)
+    noCompare.add("p", [], 100, 50, 3)
+    noCompare.add("ms", [0, 2], 900, 100, 1)
+    noCompare.add("&", [1, 2], 10, 31, 1)
+    noCompare.remove("i", [], 100, 100, 1)
+    noCompare.remove("p", [], 103, 1, 1)
+    noCompare.remove("&", [1], 20, 6, 1)
+    noCompare.add("i", [], 150, 3, 0)
+
+    assert ("i", 0, 99) in noCompare
+    assert ("i", 0, 100) not in noCompare
+    assert ("i", 0, 150) in noCompare
+    assert ("i", 0, 151) not in noCompare
+    assert ("p", 0, 100) in noCompare
+    assert ("p", 0, 101) not in noCompare
+    assert ("p", 0, 103) not in noCompare
+    assert ("ms", 2, 950) in noCompare
+    assert ("ms", 1, 950) not in noCompare
+    assert ("q", 1, 20) not in noCompare
+    assert ("q", 2, 20) in noCompare
+    assert ("m", 0, 1) not in noCompare
+    assert noCompare.mask("m", 0, 10) is None
+    mask = noCompare.mask("p", 0, 250)
+    assert [n for n in range(250) if mask[n]] == [
+        n for n in range(250) if ("p", 0, n) in noCompare
+    ]
+
+    # A copy takes the members at the time, and later changes to either
+    # set leave the other alone
+    copy = VariableSet()
+    copy.add("i", [], 8000, 1, 1)
+    copy.remove("i", [], 0, 10, 1)
+    copy.update(noCompare)
+    noCompare.remove("i", [], 0, 8192, 1)
+    copy.remove("p", [], 100, 1, 1)
+    assert ("i", 0, 5) in copy
+    assert ("i", 0, 100) not in copy
+    assert ("i", 0, 5) not in noCompare
+    assert ("p", 0, 100) in noCompare
+    for family, node, length in (("i", 0, 8192), ("p", 0, 300), ("q", 1, 50)):
+        mask = copy.mask(family, node, length)
+        assert [n for n in range(length) if mask[n]] == [
+            n for n in range(length) if (family, node, n) in copy
+        ]
+
+
+def test_variable_addresses():
+    state = PmacState("state")
+    state.getQVariable(2, 15).set(1.5)
+    state.getMsIVariable(4, 910).set("$1")
+    variables = [
+        PmacIVariable(130),
+        PmacMVariable(7),
+        PmacQVariable(3, 10),
+        PmacMsIVariable(16, 2),
+        PmacFeedrateOverride(5),
+        state.getQVariable(2, 15),
+        state.getMsIVariable(4, 910),
+    ]
+    assert [var.typeStr for var in variables] == [
+        "i130",
+        "m7",
+        "&3q10",
+        "ms16i2",
+        "&5%0",
+        "&2q15",
+        "ms4i910",
+    ]
+    # Neither variables nor their views have an instance dictionary
+    assert not any(hasattr(var, "__dict__") for var in variables)
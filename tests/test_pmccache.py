@@ -0,0 +1,33 @@
+import os
+
+from dls_pmacanalyse import pmccache
+from dls_pmacanalyse.pmccache import PreprocessorCache
+
+
+def test_preprocessor_cache(tmp_path, monkeypatch):
+    (tmp_path / "ref.pmc").write_text('#define GAIN 2000\n#include "inc.pmc"\n')
+    include = tmp_path / "inc.pmc"
+    include.write_text("i130=GAIN\n")
+    cache = PreprocessorCache(str(tmp_path / "cache"))
+    fileName = str(tmp_path / "ref.pmc")
+
+    output = cache.preprocess(fileName, None)
+    assert "i130=2000" in output
+
+    # An unchanged reference is not preprocessed again
+    calls = []
+
+    def preprocess(fileName, includePaths):
+        calls.append(fileName)
+        return realPreprocess(fileName, includePaths)
+
+    realPreprocess = pmccache.preprocess
+    monkeypatch.setattr(pmccache, "preprocess", preprocess)
+    assert cache.preprocess(fileName, None) == output
+    assert calls == []
+
+    # Changing an include invalidates the entry
+    include.write_text("i130=GAIN+1\n")
+    os.utime(include, ns=(0, 0))
+    assert "i130=2000+1" in cache.preprocess(fileName, None)
+    assert calls == [fileName]
@@ -0,0 +1,118 @@
+import asyncio
+import gzip
+import json
+
+from dls_pmacanalyse.pmac import Pmac
+from dls_pmacanalyse.simulator import PmacSimulator
+
+PMC = """
+p100=42
+open plc 3 clear
+p101=p101+1
+close
+"""
+
+
+def test_record_and_replay(tmp_path):
+    pmcFile = tmp_path / "sim.pmc"
+    pmcFile.write_text(PMC)
+    state = PmacSimulator.loadState([str(pmcFile)], useFactoryDefs=False)
+    simulator = PmacSimulator(state, geobrick=True)
+    sessionFile = str(tmp_path / "sim.session.gz")
+
+    async def record():
+        server = await simulator.start("localhost", 0)
+        async with server:
+            port = server.sockets[0].getsockname()[1]
+            pmac = Pmac("sim")
+            pmac.setProtocol("localhost", port, False)
+            pmac.setRecordFile(sessionFile)
+            await pmac.readHardwareAsync(None, False, False, False, False)
+            return pmac
+
+    recorded = asyncio.run(record())
+    numRequests = simulator.numRequests
+
+    replayed = Pmac("sim")
+    replayed.setProtocol("localhost", 1, False)
+    replayed.setReplayFile(sessionFile)
+    replayed.readHardware(None, False, False, False, False)
+
+    assert simulator.numRequests == numRequests
+    assert replayed.hardwareState.getPVariable(100).v == 42
+    assert replayed.hardwareState.dump() == recorded.hardwareState.dump()
+
+
+def test_replay_of_pmacs_sharing_an_address(tmp_path):
+    pmcFile = tmp_path / "sim.pmc"
+    pmcFile.write_text(PMC)
+    state = PmacSimulator.loadState([str(pmcFile)], useFactoryDefs=False)
+    simulator = PmacSimulator(state, geobrick=True)
+
+    async def record():
+        server = await simulator.start("localhost", 0)
+        async with server:
+            port = server.sockets[0].getsockname()[1]
+            for name in ("a", "b"):
+                pmac = Pmac(name)
+                pmac.setProtocol("localhost", port, False)
+                pmac.setRecordFile(str(tmp_path / f"{name}.session.gz"))
+                await pmac.readHardwareAsync(None, False, False, False, False)
+            return pmac
+
+    recorded = asyncio.run(record())
+
+    # The second PMAC read at the same address replays on its own
+    replayed = Pmac("b")
+    replayed.setProtocol("localhost", 1, False)
+    replayed.setReplayFile(str(tmp_path / "b.session.gz"))
+    replayed.readHardware(None, False, False, False, False)
+
+    assert replayed.hardwareState.dump() == recorded.hardwareState.dump()
+
+
+def test_block_sizes_carry_over_to_the_next_readout(tmp_path):
+    pmcFile = tmp_path / "sim.pmc"
+    pmcFile.write_text(PMC)
+    state = PmacSimulator.loadState([str(pmcFile)], useFactoryDefs=False)
+    simulator = PmacSimulator(state, geobrick=True)
+    blockSizeFile = str(tmp_path / "blocksizes.json")
+    sessionFile = str(tmp_path / "sim.session.gz")
+
+    async def read(record):
+        server = await simulator.start("localhost", 0)
+        async with server:
+            port = server.sockets[0].getsockname()[1]
+            pmac = Pmac("sim")
+            pmac.setProtocol("localhost", port, False)
+            pmac.setBlockSizeFile(blockSizeFile)
+            if record:
+                pmac.setRecordFile(sessionFile)
+            await pmac.readHardwareAsync(None, False, False, False, False)
+            return pmac
+
+    first = asyncio.run(read(False))
+    with open(blockSizeFile) as file:
+        learnt = json.load(file)
+    assert learnt == first.blockSizes
+    assert learnt["i"] != Pmac.initialBlockSize
+
+    # The second readout starts from the learnt sizes, and records them
+    second = asyncio.run(read(True))
+    with gzip.open(sessionFile, "rt") as file:
+        header = json.loads(file.readline())
+        commands = [json.loads(line)[0] for line in file]
+    assert header["blockSizes"] == learnt
+    assert f"i0..{learnt['i'] - 1}" in commands
+    assert f"i0..{Pmac.initialBlockSize - 1}" not in commands
+
+    # A replay starts from the recorded sizes whatever has been learnt since
+    with open(blockSizeFile, "w") as file:
+        json.dump({"i": Pmac.minBlockSize}, file)
+    replayed = Pmac("sim")
+    replayed.setProtocol("localhost", 1, False)
+    replayed.setBlockSizeFile(blockSizeFile)
+    replayed.setReplayFile(sessionFile)
+    replayed.readHardware(None, False, False, False, False)
+    assert replayed.timing.summary()["commands"] == len(commands)
+    assert replayed.hardwareState.dump() == second.hardwareState.dump()
@@ -0,0 +1,127 @@
+import asyncio
+import threading
+
+import pytest
+
+from dls_pmacanalyse.asyncinterface import AsyncRemotePmacInterface
+from dls_pmacanalyse.pmac import Pmac
+from dls_pmacanalyse.simulator import PmacSimulator
+
+PMC = """
+&1#3->100X
+p100=42
+i130=12000
+open plc 3 clear
+if (p100>3)
+p101=p101+1
+endif
+close
+open program 10 clear
+linear
+abs
+x10y20f100
+close
+"""
+
+
+@pytest.fixture
+def simulator(tmp_path):
+    pmcFile = tmp_path / "sim.pmc"
+    pmcFile.write_text(PMC)
+    state = PmacSimulator.loadState([str(pmcFile)], useFactoryDefs=False)
+    return PmacSimulator(state, geobrick=True)
+
+
+def checkReadout(pmac):
+    state = pmac.hardwareState
+    assert state.getPVariable(100).v == 42
+    assert state.getIVariable(130).v == 12000
+    assert state.getCsAxisDef(1, 3).valueText().strip() == "100X"
+    plc = state.getPlcProgramNoCreate(3)
+    assert plc is not None and "ENDIF" in plc.valueText()
+    prog = state.getMotionProgramNoCreate(10)
+    assert prog is not None and "LINEAR" in prog.valueText()
+    assert state.getPlcProgramNoCreate(4) is None
+    assert state.getMotionProgramNoCreate(11) is None
+    timing = pmac.timing.summary()
+    assert timing["phases"]["readIvars"]["commands"] > 0
+    assert timing["commands"] == sum(
+        phase["commands"] for phase in timing["phases"].values()
+    )
+
+
+@pytest.mark.parametrize("termServ", [False, True])
+def test_simulator_async_readout(simulator, termServ):
+    async def readout():
+        server = await simulator.start("localhost", 0, termServ)
+        async with server:
+            port = server.sockets[0].getsockname()[1]
+            pmac = Pmac("sim")
+            pmac.setProtocol("localhost", port, termServ)
+            await pmac.readHardwareAsync(None, False, False, False, False)
+            return pmac
+
+    checkReadout(asyncio.run(readout()))
+
+
+def test_simulator_readout(simulator):
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(simulator.start("localhost", 0))
+    port = server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        pmac = Pmac("sim")
+        pmac.setProtocol("localhost", port, False)
+        pmac.readHardware(None, False, False, False, False)
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+    checkReadout(pmac)
+
+
+def test_simulator_round_trips(simulator):
+    async def readout():
+        server = await simulator.start("localhost", 0)
+        async with server:
+            port = server.sockets[0].getsockname()[1]
+            pmac = Pmac("sim")
+            pmac.setProtocol("localhost", port, False)
+            await pmac.readHardwareAsync(None, False, False, False, False)
+            return pmac
+
+    pmac = asyncio.run(readout())
+    phases = {
+        name: phase["commands"]
+        for name, phase in pmac.timing.summary()["phases"].items()
+    }
+    # The configuration queries share a line, as do the Q variables of a
+    # coordinate system and its axis definitions
+    assert phases["determineConfiguration"] == 1
+    assert phases["readCoordinateSystemDefinitions"] == 1
+    assert phases["readQvars"] == 1
+    # Listing an undefined program is an error that ends its line, so each
+    # costs a round trip, but a defined program shares its probe with the
+    # next one and needs only one more to list the rest of it
+    assert phases["readMotionPrograms"] == 254 + 1
+    assert phases["readPlcPrograms"] == 31 + 1
+    assert phases["readKinematicPrograms"] == 2
+    assert sum(phases.values()) == 365
+    # The connection check is the one request outside the readout
+    assert simulator.numRequests == 366
+
+
+def test_simulator_error_injection(simulator):
+    simulator.errorRate = 1.0
+    assert simulator.answerLine("i100") == "\x07ERR001\r"
+    simulator.errorRate = 0.0
+    assert simulator.answerLine("p100 p101") == "42\r0\r\x06"
+    assert simulator.answerLine("p100 bad p101") == "42\r\x07ERR003\r"
+
+
+def test_async_interface_is_abstract():
+    with pytest.raises(TypeError):
+        AsyncRemotePmacInterface()